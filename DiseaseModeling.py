@@ -1,5 +1,17 @@
-import math
+import hashlib
+import heapq
+import importlib.util
+import os
+import pickle
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import joblib
 import numpy as np
 import pandas as pd
 import scipy.stats
@@ -25,113 +37,612 @@ class Progress:
     progress_total = 0.00
     name = ""
     show = True
+    rate_unit = None
+    start_time = 0.00
 
-    def __init__(self, pc, pt, name, show):
+    def __init__(self, pc, pt, name, show, rate_unit=None):
         self.progress_complete = pc
         self.progress_total = pt
         self.name = name
         self.show = show
+        self.rate_unit = rate_unit
+        self.start_time = time.time()
         if self.show:
             sys.stdout.write("\rProgress: {:.2%} [{}]".format(0, name))
             sys.stdout.flush()
 
-    def update_progress(self):
+    def update_progress(self, amount=1.00):
         # Update progress
-        self.progress_complete += 1.00
+        self.progress_complete += amount
         if self.show:
-            sys.stdout.write("\rProgress: {:.2%} [{}]".format(self.progress_complete / self.progress_total, self.name))
+            sys.stdout.write("\rProgress: {:.2%} [{}]{}".format(self.progress_complete / self.progress_total, self.name,
+                                                                self.rate()))
             sys.stdout.flush()
         if (self.progress_complete == self.progress_total) and self.show:
             print("")
 
+    def rate(self):
+        # Rate of progress (e.g. rows per second) if a unit was given
+        elapsed = time.time() - self.start_time
+        if self.rate_unit is None or elapsed <= 0:
+            return ""
+        return " ({:.0f} {}/s)".format(self.progress_complete / elapsed, self.rate_unit)
+
 
 # Helper method for retrieving a pre-organized data set
 def retrieve_data(filename, keys):
     # Retrieve preprocessed data from file
-    data = pd.read_csv(filename)
+    data = read_artifact(filename)
 
-    # Convert to correct dtypes
-    data[keys] = data[keys].apply(pd.to_numeric, errors="coerce")
+    # Convert to correct dtypes (only needed for csv, columnar formats keep dtypes)
+    if os.path.splitext(resolve_artifact(filename))[1] == ".csv":
+        data[keys] = data[keys].apply(pd.to_numeric, errors="coerce")
 
     # Return data
     return data
 
 
-# TODO: Consider which categorical features can have NAs eliminated through binary dummies
-# Data specific operations (Merge into one file, generate time from baseline in months, standardize feature name/values)
-def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untreated="treated_and_untreated",
-                    print_results=False, data_merged_sc_into_bl_file_path=None, data_filename="preprocessed_data.csv"):
-    # Import the data frames from files
-    with np.warnings.catch_warnings():
-        np.warnings.simplefilter("ignore")
-        all_patients = pd.read_csv("data/raw_data/all_pats.csv")
-        all_visits = pd.read_csv("data/raw_data/all_visits.csv")
-        all_updrs = pd.read_csv("data/raw_data/all_updrs.csv")
-        updrs_part_iii = pd.read_csv("data/raw_data/MDS_UPDRS_Part_III__Post_Dose_.csv")
-        blood_chemistry_hematology = pd.read_csv("data/raw_data/Blood_Chemistry___Hematology.csv")
+# Helper method for making object columns of mixed types storable in typed columnar formats: numeric mixes (e.g. ints
+# and floats) become numeric, and mixes with strings (or of otherwise incompatible types) become strings
+def columnar_compatible(data):
+    mixed = [column for column in data.columns if data[column].dtype == object and
+             pd.api.types.infer_dtype(data[column], skipna=True) in ["mixed", "mixed-integer", "mixed-integer-float"]]
+    if not mixed:
+        return data
+    data = data.copy()
+    for column in mixed:
+        values = data[column].dropna()
+        if not values.map(lambda value: isinstance(value, str)).any():
+            try:
+                data[column] = pd.to_numeric(data[column])
+                continue
+            except (ValueError, TypeError):
+                pass
+        data[column] = data[column].where(data[column].isnull(), data[column].astype(str))
+    return data
+
+
+# Helper method for reading a columnar artifact memory-mapped
+def read_columnar(filename, artifact_format):
+    if artifact_format == "parquet":
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(filename, memory_map=True).to_pandas()
+    import pyarrow.feather
+    return pyarrow.feather.read_table(filename, memory_map=True).to_pandas()
+
+
+# Artifact formats: extension, writer, and reader (parquet and feather keep dtypes and datetimes, csv does not, and
+# pickle keeps every dtype, including mixed object columns, but is only readable from python)
+artifact_formats = {
+    "parquet": (".parquet", lambda data, filename: columnar_compatible(data).to_parquet(filename, index=False),
+                lambda filename: read_columnar(filename, "parquet")),
+    "feather": (".feather", lambda data, filename: columnar_compatible(data).reset_index(drop=True).to_feather(
+        filename), lambda filename: read_columnar(filename, "feather")),
+    "pickle": (".pkl", lambda data, filename: data.to_pickle(filename), pd.read_pickle),
+    "csv": (".csv", lambda data, filename: data.to_csv(filename, index=False), pd.read_csv)}
+
+
+# Helper method for deleting the artifacts of a filename in every format and in partitions (except those kept), so
+# that a stale artifact in another format can never be read in place of a newer one
+def remove_artifact(filename, keep=()):
+    base = os.path.splitext(filename)[0]
+    for path in [base + extension for extension, writer, reader in artifact_formats.values()]:
+        if path not in keep and os.path.isfile(path):
+            os.remove(path)
+    if partitions_directory(filename) not in keep:
+        shutil.rmtree(partitions_directory(filename), ignore_errors=True)
+
+
+# Helper method for writing an intermediate data set in an artifact format (optionally also exported as csv), replacing
+# its artifacts in other formats. Columnar formats fall back to csv (with a warning) when pyarrow is not installed.
+def write_artifact(data, filename, artifact_format="parquet", export_csv=False):
+    # Columnar formats need pyarrow
+    if artifact_format in ["parquet", "feather"] and importlib.util.find_spec("pyarrow") is None:
+        warnings.warn("pyarrow is not installed, writing '{}' as csv instead of {}".format(filename, artifact_format))
+        artifact_format = "csv"
+
+    # Replace extension with the format's
+    base = os.path.splitext(filename)[0]
+    extension, writer, reader = artifact_formats[artifact_format]
+
+    # Remove artifacts in other formats
+    remove_artifact(filename, keep=[base + extension] + ([base + ".csv"] if export_csv else []))
+
+    # Write artifact
+    writer(data, base + extension)
+
+    # Export csv
+    if export_csv and artifact_format != "csv":
+        artifact_formats["csv"][1](data, base + ".csv")
+
+    # Return filename written
+    return base + extension
+
+
+# Helper method for the directory of an artifact written in partitions (one artifact per partition)
+def partitions_directory(filename):
+    return os.path.splitext(filename)[0] + "_partitions"
+
+
+# Helper method for finding the artifact of a filename: its columnar (or pickle) artifact or partitions, or else its csv
+# (write_artifact leaves only one of them, besides a csv export, which is written after but loses the dtypes of its
+# artifact)
+def resolve_artifact(filename):
+    base = os.path.splitext(filename)[0]
+    candidates = [base + extension for extension, writer, reader in artifact_formats.values()
+                  if extension != ".csv" and os.path.exists(base + extension)]
+    if os.path.isdir(partitions_directory(filename)):
+        candidates.append(partitions_directory(filename))
+    if not candidates and os.path.exists(base + ".csv"):
+        candidates.append(base + ".csv")
+    return max(candidates, key=os.path.getmtime) if candidates else filename
+
+
+# Helper method for the artifacts of a partitions directory, in partition order
+def artifact_parts(directory):
+    return [os.path.join(directory, base) for base in sorted(
+        set(os.path.splitext(part)[0] for part in os.listdir(directory)), key=lambda base: int(base.rsplit("_", 1)[1]))]
+
+
+# Helper method for concatenating data sets, keeping columns categorical in all of them categorical (with the union of
+# their categories, sorted) rather than object
+def concat_frames(frames):
+    categorical = [column for column in frames[0].columns if all(
+        column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+    data = pd.concat(frames, ignore_index=True)
+    for column in categorical:
+        data[column] = data[column].astype(pd.CategoricalDtype(pd.api.types.union_categoricals(
+            [frame[column] for frame in frames], sort_categories=True).categories))
+    return data
+
 
+# Helper method for making the categories of categorical columns those observed, sorted
+def observed_categories(data):
+    return data.assign(**dict((column, data[column].cat.remove_unused_categories().cat.set_categories(
+        data[column].cat.remove_unused_categories().cat.categories.sort_values())) for column in data.columns
+                              if isinstance(data[column].dtype, pd.CategoricalDtype)))
+
+
+# Helper method for reading an artifact (in whichever format it was most recently written, partitions concatenated)
+def read_artifact(filename):
+    filename = resolve_artifact(filename)
+    if os.path.isdir(filename):
+        parts = artifact_parts(filename)
+        return concat_frames([read_artifact(part) for part in parts]) if parts else pd.DataFrame()
+    for extension, writer, reader in artifact_formats.values():
+        if filename.endswith(extension):
+            return reader(filename)
+    return pd.read_csv(filename)
+
+
+# Helper method for iterating over an artifact in chunks of rows (columnar artifacts by their record batches)
+def iterate_artifact(filename, chunk_size):
+    filename = resolve_artifact(filename)
+    if os.path.isdir(filename):
+        for part in artifact_parts(filename):
+            for data in iterate_artifact(part, chunk_size):
+                yield data
+    elif filename.endswith(".parquet"):
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(filename, memory_map=True).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif filename.endswith(".feather"):
+        import pyarrow.ipc
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(filename))
+        for batch in range(reader.num_record_batches):
+            yield reader.get_batch(batch).to_pandas()
+    elif filename.endswith(".pkl"):
+        yield pd.read_pickle(filename)
+    else:
+        for data in pd.read_csv(filename, chunksize=chunk_size):
+            yield data
+
+
+# UPDRS Part III items (shared by all_updrs and the post dose Part III table and used to join them)
+updrs_part_iii_items = ["NP3SPCH", "NP3FACXP", "NP3RIGN", "NP3RIGRU", "NP3RIGLU", "PN3RIGRL", "NP3RIGLL", "NP3FTAPR",
+                        "NP3FTAPL", "NP3HMOVR", "NP3HMOVL", "NP3PRSPR", "NP3PRSPL", "NP3TTAPR", "NP3TTAPL", "NP3LGAGR",
+                        "NP3LGAGL", "NP3RISNG", "NP3GAIT", "NP3FRZGT", "NP3PSTBL", "NP3POSTR", "NP3BRADY", "NP3PTRMR",
+                        "NP3PTRML", "NP3KTRMR", "NP3KTRML", "NP3RTARU", "NP3RTALU", "NP3RTARL", "NP3RTALL", "NP3RTALJ",
+                        "NP3RTCON"]
+
+# Raw PPMI tables: file, columns to read (None for all but the unused ones), dtypes, and date columns (absent columns are
+# skipped). Preprocessing itself reads the keys, selection, encoding, and date columns, and never skips them.
+raw_data_dates = ["INFODT", "BIRTHDT.x", "PDDXDT", "SXDT"]
+raw_data_formats = ["%m/%Y", "%m/%d/%Y", "%Y-%m-%d", "%Y"]
+raw_data_columns = ["PATNO", "EVENT_ID", "ON_OFF_DOSE", "PD_MED_USE", "RECRUITMENT_CAT", "ENROLL_STATUS",
+                    "PAG_UPDRS3", "HANDED"] + raw_data_dates
+raw_data_schemas = {
+    "all_pats": {"filename": "data/raw_data/all_pats.csv", "usecols": None,
+                 "dtype": {"PATNO": "int64", "RECRUITMENT_CAT": "category", "ENROLL_STATUS": "category",
+                           "ENROLL_CAT": "category", "IMAGING_CAT": "category"}, "parse_dates": raw_data_dates},
+    "all_visits": {"filename": "data/raw_data/all_visits.csv", "usecols": None, "dtype": {"PATNO": "int64"},
+                   "parse_dates": raw_data_dates},
+    "all_updrs": {"filename": "data/raw_data/all_updrs.csv",
+                  "usecols": ["PATNO", "EVENT_ID", "TOTAL", "ANNUAL_TIME_BTW_DOSE_NUPDRS", "ON_OFF_DOSE",
+                              "PD_MED_USE"] + updrs_part_iii_items, "dtype": {"PATNO": "int64"}, "parse_dates": []},
+    "updrs_part_iii": {"filename": "data/raw_data/MDS_UPDRS_Part_III__Post_Dose_.csv",
+                       "usecols": ["PATNO", "EVENT_ID", "TOTAL", "ANNUAL_TIME_BTW_DOSE_NUPDRS", "ON_OFF_DOSE",
+                                   "PD_MED_USE"] + updrs_part_iii_items, "dtype": {"PATNO": "int64"},
+                       "parse_dates": []},
+    "blood_chemistry_hematology": {"filename": "data/raw_data/Blood_Chemistry___Hematology.csv",
+                                   "usecols": ["PATNO", "LTSTNAME", "LSIRES"], "dtype": {"PATNO": "int64"},
+                                   "parse_dates": []}}
+
+
+# Helper method for a raw table's file, and the columns, dtypes, and date columns of its schema that the file has (for
+# a schema reading all columns, all but the unused columns, keeping those of preprocessing and of feature definitions)
+def raw_table_options(name, unused_columns=()):
+    schema = raw_data_schemas[name]
+    header = list(pd.read_csv(schema["filename"], nrows=0).columns)
+    if schema["usecols"] is None:
+        used = set(raw_data_columns + [column for definition in feature_definitions.values() for column in (
+            definition["inputs"](header) if callable(definition["inputs"]) else definition["inputs"])])
+        usecols = [column for column in header if column in used or column not in unused_columns]
+    else:
+        usecols = [column for column in header if column in schema["usecols"]]
+    dtype = {column: column_type for column, column_type in schema["dtype"].items() if column in usecols}
+    parse_dates = [column for column in schema["parse_dates"] if column in usecols]
+    return schema["filename"], usecols, dtype, parse_dates
+
+
+# Helper method for parsing a raw date column, each date by the first of raw_data_formats it matches (month/year and
+# full dates alike). Raises on dates matching none of them, instead of silently making them NaT.
+def parse_raw_dates(values, name):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = values.where(values.isnull(), values.astype(str))
+    dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for date_format in raw_data_formats:
+        unparsed = dates.isnull() & text.notnull()
+        if not unparsed.any():
+            break
+        dates[unparsed] = pd.to_datetime(text[unparsed], format=date_format, errors="coerce")
+
+    # Fail on malformed dates
+    malformed = text[dates.isnull() & text.notnull()]
+    if len(malformed.index):
+        raise ValueError("{} malformed dates in column '{}' of '{}' (matching none of {}), e.g. {}".format(
+            len(malformed.index), values.name, name, raw_data_formats, list(malformed.unique()[:5])))
+    return dates
+
+
+# Helper method for reading a raw table by its schema (only its columns, typed, with the fastest available engine)
+def load_raw_table(name, print_results=False, unused_columns=()):
+    start_time = time.time()
+    filename, usecols, dtype, parse_dates = raw_table_options(name, unused_columns)
+
+    # Read with pyarrow if installed (multithreaded), otherwise with the c engine in one pass (consistent dtypes)
+    engine_options = {"engine": "pyarrow"} if importlib.util.find_spec("pyarrow") is not None else {
+        "engine": "c", "low_memory": False}
+    data = pd.read_csv(filename, usecols=usecols, dtype=dtype, **engine_options)
+
+    # Parse dates
+    for column in parse_dates:
+        data[column] = parse_raw_dates(data[column], name)
+
+    # Report file size and time
+    if print_results:
+        print("Loaded '{}': {} rows x {} columns from a {:.1f} MB file in {:.2f}s".format(
+            name, len(data.index), len(data.columns), os.path.getsize(filename) / 2 ** 20,
+            time.time() - start_time))
+
+    # Return data
+    return data
+
+
+# Helper method for converting categorical data to binary dummy columns of observed values only (categorical dtypes
+# would otherwise add all-zero columns for their unused categories)
+def observed_dummies(data, columns, drop_first=False):
+    data = data.astype(dict((column, object) for column in columns
+                            if isinstance(data[column].dtype, pd.CategoricalDtype)))
+    return pd.get_dummies(data, columns=columns, drop_first=drop_first)
+
+
+# Helper method for fingerprinting a file (or the files of a directory) by content
+def file_fingerprint(filename):
+    key = hashlib.sha1()
+    paths = [os.path.join(filename, name) for name in sorted(os.listdir(filename))] if os.path.isdir(filename) else [
+        filename]
+    for path in paths:
+        with open(path, "rb") as data_file:
+            for block in iter(lambda: data_file.read(2 ** 20), b""):
+                key.update(block)
+    return key.hexdigest()
+
+
+# Helper method for the signature of the files written for an artifact in any format (or in partitions): their paths,
+# sizes, and modification times
+def artifact_signature(filename):
+    base = os.path.splitext(filename)[0]
+    paths = [base + extension for extension, writer, reader in artifact_formats.values()]
+    if os.path.isdir(partitions_directory(filename)):
+        paths += [os.path.join(partitions_directory(filename), name)
+                  for name in sorted(os.listdir(partitions_directory(filename)))]
+    return [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths if os.path.isfile(path)]
+
+
+# Helper method for running a pipeline stage, memoized on disk by its input files, arguments, random state, and code
+# version. A cached result is only used while the artifacts the stage wrote (output_files) are as it left them, and
+# restores the random state the stage left, so that a hit has the same effects as running the stage. Least recently
+# used results are evicted once the cache exceeds cache_max_bytes.
+def run_stage(stage, cache_dir, input_files, output_files, *args, cache_max_bytes=2 ** 30, **kwargs):
+    # Run without cache
+    if cache_dir is None:
+        return stage(*args, **kwargs)
+
+    # Code version (content of the modeling modules)
+    code_version = [file_fingerprint(filename) for filename in [__file__, mL.__file__]]
+
+    # Key: stage, code version, input files by content, random state, and arguments (data frames by content)
+    key = mL.fingerprint(stage.__name__, code_version, [file_fingerprint(filename) for filename in input_files],
+                         pickle.dumps(np.random.get_state()), *(list(args) + [
+                             item for name_value in sorted(kwargs.items(), key=lambda pair: pair[0])
+                             for item in name_value]))
+    cache_path = os.path.join(cache_dir, "{}_{}.pkl".format(stage.__name__, key))
+
+    # Skip stage if its result is cached and its artifacts are intact
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as cache_file:
+            cached = pickle.load(cache_file)
+        if cached["artifacts"] == [artifact_signature(filename) for filename in output_files]:
+            print("Loaded '{}' from stage cache".format(stage.__name__))
+            os.utime(cache_path, None)
+            np.random.set_state(cached["random_state"])
+            return cached["result"]
+
+    # Run stage
+    result = stage(*args, **kwargs)
+
+    # Store result, the signatures of the artifacts written, and the random state after the stage
+    mL.dump_atomic({"result": result, "artifacts": [artifact_signature(filename) for filename in output_files],
+                    "random_state": np.random.get_state()}, cache_path)
+
+    # Evict least recently used results like the search cache (a result larger than the whole cache is not kept)
+    if os.path.getsize(cache_path) > cache_max_bytes:
+        os.remove(cache_path)
+    else:
+        mL.evict_search_cache(cache_dir, cache_max_bytes, keep=os.path.splitext(os.path.basename(cache_path))[0])
+
+    # Return result
+    return result
+
+
+# Helper method for splitting rows into at most n_shards shards of whole patients with balanced row counts (largest
+# patients first, each to the least loaded shard), as sorted row positions
+def balanced_shards(data, id_name, n_shards):
+    codes = pd.factorize(data[id_name])[0]
+    sizes = np.bincount(codes)
+    n_shards = max(1, min(n_shards, len(sizes)))
+    loads = [(0, shard) for shard in range(n_shards)]
+    assignments = np.empty(len(sizes), dtype=int)
+    for patient in np.argsort(-sizes, kind="stable"):
+        load, shard = heapq.heappop(loads)
+        assignments[patient] = shard
+        heapq.heappush(loads, (load + sizes[patient], shard))
+    row_shards = assignments[codes]
+    return [positions for positions in (np.flatnonzero(row_shards == shard) for shard in range(n_shards))
+            if len(positions)]
+
+
+# Helper method for a data frame as an Arrow table with its dtypes unchanged by the round trip: object columns other
+# than strings (e.g. mixed ints and strings), which Arrow would convert, are pickled into the schema metadata instead
+def frame_to_arrow(data):
+    import pyarrow
+    pickled = [column for column in data.columns if data[column].dtype == object and
+               pd.api.types.infer_dtype(data[column], skipna=True) not in ["string", "empty"]]
+    table = pyarrow.Table.from_pandas(data.drop(columns=pickled), preserve_index=True)
+    if pickled:
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            b"pickled_columns": pickle.dumps((list(data.columns), data[pickled].reset_index(drop=True)))})
+    return table
+
+
+# Helper method for a data frame as Arrow IPC stream bytes
+def frame_to_stream(data):
+    import pyarrow
+    table = frame_to_arrow(data)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# Helper method for a data frame as an Arrow IPC stream, copied into a new block of shared memory (returned with size),
+# so that no view of the block outlives the copy and the block can be closed
+def frame_to_shared_memory(data):
+    stream = frame_to_stream(data)
+    block = shared_memory.SharedMemory(create=True, size=max(len(stream), 1))
+    block.buf[:len(stream)] = stream
+    return block, len(stream)
+
+
+# Helper method for reading a data frame from an Arrow IPC stream (bytes or a buffer), with its pickled columns
+def frame_from_arrow(buffer):
+    import pyarrow
+    table = pyarrow.ipc.open_stream(pyarrow.py_buffer(buffer)).read_all()
+    data = table.to_pandas()
+    if b"pickled_columns" not in (table.schema.metadata or {}):
+        return data
+    columns, pickled = pickle.loads(table.schema.metadata[b"pickled_columns"])
+    for column in pickled.columns:
+        data[column] = pickled[column].values
+    return data[columns]
+
+
+# Helper method for running a transform on a shard read from shared memory, returning its result as Arrow IPC bytes
+# (the shard's stream is copied out of the block first, so that no view of the block outlives it)
+def transform_shard(transform, name, size, kwargs):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        stream = bytes(block.buf[:size])
+    finally:
+        block.close()
+    return frame_to_stream(transform(frame_from_arrow(stream), **kwargs))
+
+
+# Run a per-patient transform(data, **kwargs) in a pool of n_jobs processes (all cores if None) on balanced shards of
+# whole patients. Shards are passed to workers as Arrow streams in shared memory and results come back as Arrow
+# streams, then are concatenated in a deterministic order: by each patient's first appearance in data, with each
+# patient's rows in the order the transform returned them. The transform must be a module-level function (its own
+# arguments, e.g. id_name, are passed through kwargs, so the key of the partitions is named partition_key).
+def map_patient_partitions(data, partition_key, transform, n_jobs=None, **kwargs):
+    # Shards (at most one per patient)
+    shards = balanced_shards(data, partition_key, joblib.effective_n_jobs(-1 if n_jobs is None else n_jobs))
+    if len(shards) <= 1:
+        return transform(data, **kwargs)
+
+    # Write shards to shared memory, transform them in parallel, and free them
+    blocks = [frame_to_shared_memory(data.iloc[positions]) for positions in shards]
+    try:
+        with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+            results = list(executor.map(transform_shard, [transform] * len(blocks),
+                                        [block.name for block, size in blocks], [size for block, size in blocks],
+                                        [kwargs] * len(blocks)))
+    finally:
+        for block, size in blocks:
+            block.close()
+            block.unlink()
+
+    # Concatenate results
+    data_ids = pd.unique(data[partition_key])
+    results = pd.concat([frame_from_arrow(result) for result in results], ignore_index=True)
+    if partition_key not in results.columns:
+        return results
+    first_appearance = pd.Series(np.arange(len(data_ids)), index=data_ids)
+    order = np.argsort(results[partition_key].map(first_appearance).values, kind="stable")
+    return results.iloc[order].reset_index(drop=True)
+
+
+# Helper method for using a patient's last screening value wherever all of their baseline values are null
+def merge_screening_into_baseline(data, id_name, event_name, screening="SC", baseline="BL"):
+    # Screening and baseline rows
+    screening_data = data[data[event_name] == screening]
+    baseline_mask = data[event_name] == baseline
+    baseline_data = data[baseline_mask]
+
+    # Columns that can be filled
+    columns = [column for column in data.columns if column != id_name]
+
+    # Fill where all of a patient's BL values are null and any of their SC values are not null
+    baseline_all_null = baseline_data[columns].isnull().groupby(baseline_data[id_name]).all()
+    screening_any = screening_data[columns].notnull().groupby(screening_data[id_name]).any()
+    fill = baseline_all_null & screening_any.reindex(baseline_all_null.index, fill_value=False)
+
+    # Last SC row of each patient
+    last_screening = screening_data.groupby(id_name).tail(1).set_index(id_name)[columns]
+
+    # Align fill flags and SC values with the BL rows
+    patients = baseline_data[id_name].values
+    fill_rows = fill.reindex(patients)
+    fill_rows.index = baseline_data.index
+    screening_rows = last_screening.reindex(patients)
+    screening_rows.index = baseline_data.index
+
+    # Fill BL values column by column, only touching columns that change
+    for column in columns:
+        if fill_rows[column].any():
+            data.loc[baseline_mask, column] = baseline_data[column].mask(fill_rows[column].astype(bool),
+                                                                         screening_rows[column])
+
+    # Return data
+    return data
+
+
+# Helper method for adding a long-format lab table (one row per patient per test) as columns of the baseline rows
+def merge_lab_results_into_baseline(data, lab_data, id_name, event_name, test_name, result_name, baseline="BL"):
+    # Order lab rows patient by patient (in order of first appearance) so new columns keep their original order
+    lab_data = lab_data[lab_data[test_name].notnull()]
+    lab_data = lab_data.iloc[np.argsort(pd.factorize(lab_data[id_name])[0], kind="stable")]
+
+    # First result of each test for each patient
+    first_results = lab_data.drop_duplicates(subset=[id_name, test_name], keep="first")
+    tests = list(first_results[test_name].unique())
+
+    # Pivot to one row per patient and one column per test
+    lab_wide = first_results.pivot(index=id_name, columns=test_name, values=result_name).reindex(columns=tests)
+
+    # Align lab results with the BL rows (all other rows stay null)
+    baseline_mask = data[event_name] == baseline
+    lab_rows = lab_wide.reindex(data[id_name].values)
+    lab_rows.index = data.index
+    lab_rows.loc[~baseline_mask] = np.nan
+
+    # Overwrite tests that already exist as columns only where the patient has a result for that test
+    existing_tests = [test for test in tests if test in data.columns]
+    if existing_tests:
+        has_results = first_results.assign(HAS_RESULT=True).pivot(index=id_name, columns=test_name,
+                                                                  values="HAS_RESULT").reindex(columns=existing_tests)
+        has_results = has_results.reindex(data[id_name].values).notnull().values & baseline_mask.values[:, None]
+        for index, test in enumerate(existing_tests):
+            data.loc[has_results[:, index], test] = lab_rows.loc[has_results[:, index], test]
+
+    # Join the remaining tests as new columns
+    data = data.join(lab_rows[[test for test in tests if test not in data.columns]])
+
+    # Return data
+    return data
+
+
+# Helper method for only including patients with at least a certain number of observations
+def filter_min_observations(data, id_name, min_observations):
+    return data[data.groupby(id_name)[id_name].transform("size") >= min_observations]
+
+
+# Helper method for only including patients with a baseline observation
+def filter_has_baseline(data, id_name, time_name, baseline_time=0):
+    return data[data[id_name].isin(data.loc[data[time_name] == baseline_time, id_name].unique())]
+
+
+# Helper method for only including patients with observations at or beyond a certain duration
+def filter_min_duration(data, id_name, time_name, min_duration):
+    return data[data[id_name].isin(data.loc[data[time_name] >= min_duration, id_name].unique())]
+
+
+# Merge the raw PPMI tables into one row per visit
+def merge_raw_tables(all_patients, all_visits, all_updrs, updrs_part_iii):
     # Include on/off data in the UPDRS dataframe to finish building all_updrs
-    all_updrs = all_updrs.merge(updrs_part_iii, how="left",
-                                on=["PATNO", "EVENT_ID", "NP3SPCH", "NP3FACXP", "NP3RIGN", "NP3RIGRU",
-                                    "NP3RIGLU", "PN3RIGRL", "NP3RIGLL", "NP3FTAPR", "NP3FTAPL", "NP3HMOVR",
-                                    "NP3HMOVL", "NP3PRSPR", "NP3PRSPL", "NP3TTAPR", "NP3TTAPL", "NP3LGAGR",
-                                    "NP3LGAGL", "NP3RISNG", "NP3GAIT", "NP3FRZGT", "NP3PSTBL", "NP3POSTR",
-                                    "NP3BRADY", "NP3PTRMR", "NP3PTRML", "NP3KTRMR", "NP3KTRML", "NP3RTARU",
-                                    "NP3RTALU", "NP3RTARL", "NP3RTALL", "NP3RTALJ",
-                                    "NP3RTCON"])[["PATNO", "EVENT_ID", "TOTAL", "ANNUAL_TIME_BTW_DOSE_NUPDRS",
-                                                  "ON_OFF_DOSE", "PD_MED_USE"]]
+    all_updrs = all_updrs.merge(updrs_part_iii, how="left", on=["PATNO", "EVENT_ID"] + updrs_part_iii_items)[
+        ["PATNO", "EVENT_ID", "TOTAL", "ANNUAL_TIME_BTW_DOSE_NUPDRS", "ON_OFF_DOSE", "PD_MED_USE"]]
 
     # Merge data
-    data_merged = all_visits.merge(all_updrs, on=["PATNO", "EVENT_ID", "ON_OFF_DOSE"], how="left").merge(
+    return all_visits.merge(all_updrs, on=["PATNO", "EVENT_ID", "ON_OFF_DOSE"], how="left").merge(
         all_patients, on="PATNO", how="left", suffixes=["_x", ""])
 
-    data_merged.to_csv("test.csv", index=False)
 
-    # Remove SC rows after combining them with BL rows
-    if data_merged_sc_into_bl_file_path is None:
-        # Initiate progress
-        prog = Progress(0, len(data_merged["PATNO"].unique()), "Merging Screening Into Baseline", print_results)
-
-        # Use SC data where BL is null
-        for subject in data_merged["PATNO"].unique():
-            if not data_merged[(data_merged["PATNO"] == subject) & (data_merged["EVENT_ID"] == "SC")].empty:
-                for column in data_merged.keys():
-                    if (data_merged.loc[(data_merged["PATNO"] == subject) & (
-                                data_merged["EVENT_ID"] == "BL"), column].isnull().values.all()) and (
-                            data_merged.loc[(data_merged["PATNO"] == subject) & (
-                                        data_merged["EVENT_ID"] == "SC"), column].notnull().values.any()):
-                        data_merged.loc[
-                            (data_merged["PATNO"] == subject) & (data_merged["EVENT_ID"] == "BL"), column] = \
-                            data_merged.loc[
-                                (data_merged["PATNO"] == subject) & (
-                                    data_merged["EVENT_ID"] == "SC"), column].tolist()[-1]
-            # Update progress
-            prog.update_progress()
+# Combine SC rows into BL rows, remove them, and add lab results to BL rows
+def merge_screening_and_labs(data_merged, blood_chemistry_hematology, print_results=False):
+    # Initiate progress
+    prog = Progress(0, 1, "Merging Screening Into Baseline", print_results)
 
-        # Remove SC rows
-        data_merged_sc_into_bl = data_merged[data_merged["EVENT_ID"] != "SC"]
+    # Use SC data where BL is null
+    data_merged = merge_screening_into_baseline(data=data_merged, id_name="PATNO", event_name="EVENT_ID")
 
-        # Initiate progress
-        prog = Progress(0, len(blood_chemistry_hematology["PATNO"].unique()), "Merging 'Blood Chemistry Hematology'",
-                        print_results)
+    # Update progress
+    prog.update_progress()
 
-        # Add blood chemistry hematology data
-        for patient in blood_chemistry_hematology["PATNO"].unique():
-            for key in blood_chemistry_hematology.loc[blood_chemistry_hematology["PATNO"] == patient, "LTSTNAME"]:
-                data_merged_sc_into_bl.loc[
-                    (data_merged_sc_into_bl["PATNO"] == patient) & (data_merged_sc_into_bl["EVENT_ID"] == "BL"), key] = \
-                    blood_chemistry_hematology.loc[(blood_chemistry_hematology["PATNO"] == patient) & (
-                        blood_chemistry_hematology["LTSTNAME"] == key), "LSIRES"].values[0]
+    # Remove SC rows
+    data_merged_sc_into_bl = data_merged[data_merged["EVENT_ID"] != "SC"]
 
-            # Update progress
-            prog.update_progress()
+    # Initiate progress
+    prog = Progress(0, len(blood_chemistry_hematology.index), "Merging 'Blood Chemistry Hematology'",
+                    print_results, rate_unit="rows")
 
-        # Create csv of all of these datasets merged after SC rows have been combined with BL and removed
-        data_merged_sc_into_bl.to_csv("data/raw_data/data_merged_SC_into_BL.csv", index=False)
-    else:
-        # Import pre-existing merged data with no SCs
-        data_merged_sc_into_bl = pd.read_csv(data_merged_sc_into_bl_file_path)
+    # Add blood chemistry hematology data
+    data_merged_sc_into_bl = merge_lab_results_into_baseline(data=data_merged_sc_into_bl,
+                                                             lab_data=blood_chemistry_hematology,
+                                                             id_name="PATNO", event_name="EVENT_ID",
+                                                             test_name="LTSTNAME", result_name="LSIRES")
+
+    # Update progress
+    prog.update_progress(len(blood_chemistry_hematology.index))
 
+    # Return data
+    return data_merged_sc_into_bl
+
+
+# Select the visits of enrolled patients of the cohorts in the on/off dose and treated/untreated periods
+def select_visits(data_merged_sc_into_bl, all_patients, cohorts, on_off_dose, treated_untreated):
     # List of patients only enrolled in selected cohorts
     patients_from_selected_cohorts = all_patients.loc[
         (np.bitwise_or.reduce(np.array([(all_patients["RECRUITMENT_CAT"] == cohort) for cohort in cohorts]))) & (
@@ -141,12 +652,7 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
     data = data_merged_sc_into_bl[data_merged_sc_into_bl["PATNO"].isin(patients_from_selected_cohorts)]
 
     # Add binary feature for whether patient is receiving symptomatic therapy
-    data.loc[:, "IS_TREATED"] = 0
-    for patient in data["PATNO"].unique():
-        if not data[(data["PATNO"] == patient) & (data["EVENT_ID"] == "ST")].empty:
-            st_date = pd.to_datetime(
-                data.loc[(data["PATNO"] == patient) & (data["EVENT_ID"] == "ST"), "INFODT"].values[0])
-            data.loc[(data["PATNO"] == patient) & (pd.to_datetime(data["INFODT"]) >= st_date), "IS_TREATED"] = 1
+    data = generate_treatment_status(data=data, id_name="PATNO", event_name="EVENT_ID", datetime_name="INFODT")
 
     # TODO: Check differentiation between on/off. Look at PD_MED_USE (untreated: PD_MED_USE = 0 and ON_OFF_DOSE is null)
     # Treated vs untreated periods
@@ -179,14 +685,6 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
         if treated_untreated == "treated":
             # TODO: Adjust baselines for treated periods! ST should be the new baseline
             data = data[data["IS_TREATED"] == 1]
-        elif treated_untreated == "treated_and_untreated":
-            # Print number of treated vs untreated patients
-            print("{} untreated {}-dose patients\n{} treated {}-dose patients\n".format(len(data.loc[data["IS_TREATED"]
-                                                                                                     == 0, "PATNO"].unique()),
-                                                                                        on_off_dose,
-                                                                                        len(data.loc[data["IS_TREATED"]
-                                                                                                     == 1, "PATNO"].unique()),
-                                                                                        on_off_dose))
     elif treated_untreated == "untreated":
         # Untreated
         # data = data[data["PD_MED_USE"] == 0]
@@ -209,11 +707,22 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
     # Drop duplicates based on PATNO and EVENT_ID, keep only first
     data = data.drop_duplicates(subset=["PATNO", "EVENT_ID"], keep="first")
 
-    # TODO: Figure out which other categorical data can be numerically encoded
-    # Encode to numeric
-    mL.clean_data(data=data, encode_auto=["HANDED", "PAG_UPDRS3"], encode_man={
-        "EVENT_ID": {"BL": 0, "V01": 1, "V02": 2, "V03": 3, "V04": 4, "V05": 5, "V06": 6, "V07": 7, "V08": 8,
-                     "V09": 9, "V10": 10, "V11": 11, "V12": 12, "V13": 13, "ST": -1}})
+    # Return data
+    return data
+
+
+# TODO: Figure out which other categorical data can be numerically encoded
+# Encodings of visits to numeric
+visit_encoding = {"encode_auto": ["HANDED", "PAG_UPDRS3"], "encode_man": {
+    "EVENT_ID": {"BL": 0, "V01": 1, "V02": 2, "V03": 3, "V04": 4, "V05": 5, "V06": 6, "V07": 7, "V08": 8, "V09": 9,
+                 "V10": 10, "V11": 11, "V12": 12, "V13": 13, "ST": -1}}}
+
+
+# Encode selected visits, generate their features, and drop patients with baseline NA at feature keys
+def generate_visit_features(data, base_target, requested_features=None, encoder=None, print_results=False,
+                            memoize=False):
+    # Encode to numeric (with the given fitted encoder, if any)
+    mL.clean_data(data=data, encoder=encoder, **visit_encoding)
 
     # Create HAS_PD column
     data.loc[:, "HAS_PD"] = 0
@@ -225,11 +734,17 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
     data.loc[data["HAS_PD"] == 0, "PDDXDT"] = pd.to_datetime("1/1/1800")
     data.loc[data["HAS_PD"] == 0, "SXDT"] = pd.to_datetime("1/1/1800")
 
+    # Drop rows with no date time and convert dates to date times
+    data = data[data["INFODT"].notnull()]
+    data = data.assign(**dict((date_name, pd.to_datetime(data[date_name]))
+                              for date_name in ["INFODT", "BIRTHDT.x", "PDDXDT", "SXDT"]))
+
     # List of features
     features = list(data.columns.values)
 
-    # Generate features (UPDRS subsets)
-    data = generate_updrs_subsets(data=data, features=features)
+    # Generate features (UPDRS subsets and times) that are requested or needed as keys
+    data = generate_features(data=data, features=features, progress=print_results, memoize=memoize,
+                             requested=None if requested_features is None else list(requested_features) + [base_target])
 
     # Set feature keys
     feature_keys = ["PATNO", "EVENT_ID", "INFODT", "PDDXDT", "SXDT", "BIRTHDT.x", "HAS_PD", base_target]
@@ -238,18 +753,211 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
     data = data[
         data["PATNO"].isin(data.loc[(data["EVENT_ID"] == 0) & (data[feature_keys].notnull().all(axis=1)), "PATNO"])]
 
+    # Keep only observed categories (so partitions concatenate to the categories of preprocessing all data at once)
+    return observed_categories(data)
+
+
+# Helper method for writing a data set's rows in partitions by patient (pieces of a partition are numbered by chunk),
+# pickled by default so that spilled pieces read back with the dtypes they were written with
+def write_partitions(data, directory, id_name, n_partitions, chunk, artifact_format="pickle"):
+    os.makedirs(directory, exist_ok=True)
+    for partition, partition_data in data.groupby(data[id_name] % n_partitions):
+        write_artifact(partition_data, os.path.join(directory, "partition_{}_chunk_{:06d}.csv".format(
+            partition, chunk)), artifact_format)
+
+
+# Helper method for reading a partition's pieces in chunk order (the template's empty columns if it has none)
+def read_partition(directory, partition, template):
+    prefix = "partition_{}_chunk_".format(partition)
+    bases = sorted(set(os.path.splitext(filename)[0] for filename in
+                       (os.listdir(directory) if os.path.isdir(directory) else []) if filename.startswith(prefix)))
+    if not bases:
+        return template.copy()
+    return concat_frames([read_artifact(os.path.join(directory, base)) for base in bases])
+
+
+# Helper method for partitioning a raw table by patient, reading it by its schema in chunks of rows
+def partition_raw_table(name, directory, n_partitions, chunk_size, print_results=False, unused_columns=()):
+    start_time = time.time()
+    filename, usecols, dtype, parse_dates = raw_table_options(name, unused_columns)
+
+    # Write each chunk's rows to their partitions
+    template = pd.DataFrame(columns=usecols)
+    rows = 0
+    for chunk, data in enumerate(pd.read_csv(filename, usecols=usecols, dtype=dtype, chunksize=chunk_size)):
+        # Parse dates
+        for column in parse_dates:
+            data[column] = parse_raw_dates(data[column], name)
+
+        # Write partitions
+        if chunk == 0:
+            template = data.iloc[0:0]
+        write_partitions(data, os.path.join(directory, name), "PATNO", n_partitions, chunk)
+        rows += len(data.index)
+
+    # Report file size and time
+    if print_results:
+        print("Partitioned '{}': {} rows x {} columns into {} partitions from a {:.1f} MB file in {:.2f}s".format(
+            name, rows, len(usecols), n_partitions, os.path.getsize(filename) / 2 ** 20, time.time() - start_time))
+
+    # Return empty template of the table
+    return template
+
+
+# Preprocess the study in partitions by patient, streaming raw tables in chunks, so that peak memory is bounded by the
+# largest partition. Visits are encoded with one encoder fitted on all partitions (the same encoding as preprocessing
+# all data at once) and each partition's output is written as it finishes (pickled, with the dtypes of preprocessing
+# all data at once) to the returned directory, "<data_filename>_partitions".
+def preprocess_partitions(base_target, cohorts, on_off_dose, treated_untreated, print_results,
+                          data_merged_sc_into_bl_file_path, data_filename, artifact_format, export_csv,
+                          requested_features, n_partitions, chunk_size, unused_columns):
+    # Output partitions (replacing the artifacts of previous runs, in any format)
+    output_directory = partitions_directory(data_filename)
+    merged_directory = partitions_directory("data/raw_data/data_merged_SC_into_BL.csv")
+    for filename in [data_filename] + (["data/raw_data/data_merged_SC_into_BL.csv"]
+                                       if data_merged_sc_into_bl_file_path is None else []):
+        remove_artifact(filename)
+        os.makedirs(partitions_directory(filename))
+
+    with tempfile.TemporaryDirectory() as spill_directory:
+        # Partition the raw tables (and any pre-existing merged data with no SCs) by patient
+        templates = dict((name, partition_raw_table(name, spill_directory, n_partitions, chunk_size, print_results,
+                                                    unused_columns)) for name in raw_data_schemas)
+        if data_merged_sc_into_bl_file_path is not None:
+            for chunk, data in enumerate(iterate_artifact(data_merged_sc_into_bl_file_path, chunk_size)):
+                if chunk == 0:
+                    templates["data_merged_sc_into_bl"] = data.iloc[0:0]
+                write_partitions(data, os.path.join(spill_directory, "data_merged_sc_into_bl"), "PATNO", n_partitions,
+                                 chunk)
+
+        # Initiate progress
+        prog = Progress(0, n_partitions, "Merging And Selecting Partitions", print_results, rate_unit="partitions")
+        os.makedirs(os.path.join(spill_directory, "selected"))
+
+        # Merge and select the visits of each partition, counting untreated and treated patients
+        selected_partitions = []
+        encoded_values = []
+        treated_counts = [0, 0]
+        for partition in range(n_partitions):
+            tables = dict((name, read_partition(os.path.join(spill_directory, name), partition, template))
+                          for name, template in templates.items())
+
+            # Merge (or use pre-existing merged data with no SCs)
+            if data_merged_sc_into_bl_file_path is None and len(tables["all_visits"].index):
+                data_merged_sc_into_bl = merge_screening_and_labs(
+                    merge_raw_tables(tables["all_pats"], tables["all_visits"], tables["all_updrs"],
+                                     tables["updrs_part_iii"]), tables["blood_chemistry_hematology"])
+                write_artifact(data_merged_sc_into_bl, os.path.join(merged_directory, "partition_{}.csv".format(
+                    partition)), artifact_format, export_csv)
+            elif data_merged_sc_into_bl_file_path is not None:
+                data_merged_sc_into_bl = tables["data_merged_sc_into_bl"]
+            else:
+                prog.update_progress()
+                continue
+
+            # Select visits
+            data = select_visits(data_merged_sc_into_bl, tables["all_pats"], cohorts, on_off_dose, treated_untreated)
+            if len(data.index):
+                treated_counts = [count + len(data.loc[data["IS_TREATED"] == is_treated, "PATNO"].unique())
+                                  for is_treated, count in enumerate(treated_counts)]
+                encoded_values.append(data[visit_encoding["encode_auto"]].drop_duplicates())
+                write_artifact(data, os.path.join(spill_directory, "selected", "partition_{}.csv".format(partition)),
+                               "pickle")
+                selected_partitions.append(partition)
+
+            # Update progress
+            prog.update_progress()
+
+        # Print number of treated vs untreated patients
+        if treated_untreated == "treated_and_untreated":
+            print("{} untreated {}-dose patients\n{} treated {}-dose patients\n".format(treated_counts[0], on_off_dose,
+                                                                                        treated_counts[1], on_off_dose))
+
+        # Encoder fitted on the values of all partitions
+        encoder = mL.Encoder(**visit_encoding).fit(
+            pd.concat(encoded_values) if encoded_values else pd.DataFrame(columns=visit_encoding["encode_auto"]))
+
+        # Initiate progress
+        prog = Progress(0, len(selected_partitions), "Generating Partition Features", print_results,
+                        rate_unit="partitions")
+
+        # Generate features of each partition and write it, counting the patients of each cohort
+        cohort_counts = dict((cohort, 0) for cohort in cohorts)
+        for partition in selected_partitions:
+            data = read_artifact(os.path.join(spill_directory, "selected", "partition_{}.csv".format(partition)))
+            data = generate_visit_features(data, base_target, requested_features, encoder)
+            write_artifact(data, os.path.join(output_directory, "partition_{}.csv".format(partition)), "pickle",
+                           export_csv)
+            for cohort in cohorts:
+                cohort_counts[cohort] += len(data.loc[data["RECRUITMENT_CAT"] == cohort, "PATNO"].unique())
+
+            # Update progress
+            prog.update_progress()
+
     # Print size of each cohort
     for cohort in cohorts:
-        print("Patients in {} cohort: {}\n".format(cohort, len(data.loc[data["RECRUITMENT_CAT"] == cohort, "PATNO"].unique())))
+        print("Patients in {} cohort: {}\n".format(cohort, cohort_counts[cohort]))
+
+    # Return directory of the partitions
+    return output_directory
+
+
+# TODO: Consider which categorical features can have NAs eliminated through binary dummies
+# Data specific operations (Merge into one file, generate time from baseline in months, standardize feature name/values)
+# With n_partitions, the study is streamed through that many partitions by patient instead of being loaded at once, and
+# the directory of the partitions written is returned instead of the data (read it with read_artifact). Raw columns in
+# unused_columns (e.g. dropped predictors) are not read, unless preprocessing or a feature definition reads them.
+def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untreated="treated_and_untreated",
+                    print_results=False, data_merged_sc_into_bl_file_path=None, data_filename="preprocessed_data.csv",
+                    artifact_format="parquet", export_csv=False, requested_features=None, n_partitions=None,
+                    chunk_size=100000, unused_columns=()):
+    # Preprocess in partitions by patient
+    if n_partitions is not None:
+        return preprocess_partitions(base_target, cohorts, on_off_dose, treated_untreated, print_results,
+                                     data_merged_sc_into_bl_file_path, data_filename, artifact_format, export_csv,
+                                     requested_features, n_partitions, chunk_size, unused_columns)
+
+    # Import the data frames from files
+    all_patients = load_raw_table("all_pats", print_results, unused_columns)
 
-    # Generate features (times)
-    data = generate_time(data=data, features=features, id_name="PATNO",
-                         time_name="EVENT_ID", datetime_name="INFODT", birthday_name="BIRTHDT.x",
-                         diagnosis_date_name="PDDXDT", first_symptom_date_name="SXDT",
-                         progress=print_results)
+    # Remove SC rows after combining them with BL rows
+    if data_merged_sc_into_bl_file_path is None:
+        # Import the data frames from files
+        all_visits = load_raw_table("all_visits", print_results, unused_columns)
+        all_updrs = load_raw_table("all_updrs", print_results)
+        updrs_part_iii = load_raw_table("updrs_part_iii", print_results)
+        blood_chemistry_hematology = load_raw_table("blood_chemistry_hematology", print_results)
+
+        # Merge data, combine SC rows with BL rows, and add lab results
+        data_merged_sc_into_bl = merge_screening_and_labs(
+            merge_raw_tables(all_patients, all_visits, all_updrs, updrs_part_iii), blood_chemistry_hematology,
+            print_results)
+
+        # Create csv of all of these datasets merged after SC rows have been combined with BL and removed
+        write_artifact(data_merged_sc_into_bl, "data/raw_data/data_merged_SC_into_BL.csv", artifact_format,
+                       export_csv)
+    else:
+        # Import pre-existing merged data with no SCs
+        data_merged_sc_into_bl = read_artifact(data_merged_sc_into_bl_file_path)
+
+    # Select visits
+    data = select_visits(data_merged_sc_into_bl, all_patients, cohorts, on_off_dose, treated_untreated)
+
+    # Print number of treated vs untreated patients
+    if treated_untreated == "treated_and_untreated":
+        print("{} untreated {}-dose patients\n{} treated {}-dose patients\n".format(
+            len(data.loc[data["IS_TREATED"] == 0, "PATNO"].unique()), on_off_dose,
+            len(data.loc[data["IS_TREATED"] == 1, "PATNO"].unique()), on_off_dose))
 
-    # Create csv
-    data.to_csv(data_filename, index=False)
+    # Generate features
+    data = generate_visit_features(data, base_target, requested_features, print_results=print_results)
+
+    # Create artifact
+    write_artifact(data, data_filename, artifact_format, export_csv)
+
+    # Print size of each cohort
+    for cohort in cohorts:
+        print("Patients in {} cohort: {}\n".format(cohort, len(data.loc[data["RECRUITMENT_CAT"] == cohort, "PATNO"].unique())))
 
     # Return pd control data
     return data.copy()
@@ -258,7 +966,8 @@ def preprocess_data(base_target, cohorts=None, on_off_dose="off", treated_untrea
 # Drop patients w/o BL, drop rows w/ NA at key features, generate outcome measure
 def process_data(data, model_type, patient_key, time_key, base_target, outcome_measure, drop_predictors=None,
                  print_results=False, output_file=False, data_filename="processed_data.csv",
-                 symptom_features_values=None, cutoff=None, post_lme_data=None, time_from=0, time_until=0.2):
+                 symptom_features_values=None, cutoff=None, post_lme_data=None, time_from=0, time_until=0.2,
+                 lme_cache_dir=None, artifact_format="parquet", export_csv=False, n_jobs=None):
     # Model type booleans
     future_score = model_type == "future_severity"
     rate_of_progression = model_type == "rate_of_progression"
@@ -272,9 +981,7 @@ def process_data(data, model_type, patient_key, time_key, base_target, outcome_m
     data = data[data[time_key] >= 0]
 
     # Drop patients without BL data
-    for patno in data[patient_key].unique():
-        if patno not in data.loc[data[time_key] == 0, patient_key].unique():
-            data = data[data[patient_key] != patno]
+    data = filter_has_baseline(data=data, id_name=patient_key, time_name=time_key)
 
     # Drop rows with NA at target keys
     for key in data_targets:
@@ -289,7 +996,13 @@ def process_data(data, model_type, patient_key, time_key, base_target, outcome_m
         return np.bitwise_or.reduce(np.array(condition))
 
     # Feature generation
-    if future_score:
+    if future_score and n_jobs is not None and n_jobs != 1:
+        # Generate new data set for predicting future visits, patients split across n_jobs processes
+        data = map_patient_partitions(data, patient_key, generate_future_score, n_jobs=n_jobs, features=features,
+                                      id_name=patient_key, score_name=base_target, time_name=time_key, progress=False,
+                                      time_from=time_from, time_until=time_until)
+        features += [column for column in data.columns if column not in features]
+    elif future_score:
         # Generate new data set for predicting future visits
         data = generate_future_score(data=data, features=features, id_name=patient_key, score_name=base_target,
                                      time_name=time_key, progress=print_results, time_from=time_from,
@@ -302,7 +1015,7 @@ def process_data(data, model_type, patient_key, time_key, base_target, outcome_m
         # Generate new data set for predicting rate of progression
         data = generate_rate_of_progression(data=data, id_name=patient_key, score_name=base_target, time_name=time_key,
                                             target=outcome_measure, progress=print_results, cutoff=cutoff,
-                                            post_lme_data=post_lme_data)
+                                            post_lme_data=post_lme_data, lme_cache_dir=lme_cache_dir)
 
     # Drop unused columns
     for column in data.keys():
@@ -312,18 +1025,118 @@ def process_data(data, model_type, patient_key, time_key, base_target, outcome_m
 
     # Save generated features data
     if output_file:
-        data.to_csv(data_filename, index=False)
+        write_artifact(data, data_filename, artifact_format, export_csv)
 
     # Return data
     return data.copy()
 
 
-# TODO: Truly maximize by searching space of all feature/patient NA-less combinations
+# Search for the subset of features maximizing features * complete rows (or features * complete rows in the smaller
+# class) with a greedy pass followed by add/remove/swap local search over column null bitsets, within a time budget
+def search_feature_subset(null_mask, protected, class_masks, time_budget=10.0):
+    # Deadline of search
+    deadline = time.time() + time_budget
+
+    # Python int bitset of a boolean row mask
+    def bitset(mask):
+        return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+    # Number of set bits
+    def count(bits):
+        return bin(bits).count("1")
+
+    # Rows not null at any protected column, class row bitsets, and null bitset of each eliminable column
+    base = bitset(~(null_mask[:, protected].any(axis=1)))
+    classes = [bitset(mask) & base for mask in class_masks]
+    columns = list(np.flatnonzero(~protected))
+    column_bits = [bitset(null_mask[:, column]) for column in columns]
+    protected_count = int(protected.sum())
+
+    # Complete rows (in smaller class) given the union of the selected columns' null bitsets
+    def complete_rows(union):
+        return min(count(class_bits & ~union) for class_bits in classes)
+
+    # Objective of a selection
+    def score(selected_count, union):
+        return (protected_count + selected_count) * complete_rows(union)
+
+    # Union of the null bitsets of selected columns
+    def union_of(selected):
+        union = 0
+        for index in selected:
+            union |= column_bits[index]
+        return union
+
+    # Upper bound: any k columns keep at most as many complete rows as the k-th best single column
+    single_counts = sorted((complete_rows(bits) for bits in column_bits), reverse=True)
+    bound = max([protected_count * complete_rows(0)] + [(protected_count + k + 1) * rows
+                                                       for k, rows in enumerate(single_counts)])
+
+    # Greedy: repeatedly add the column that loses the fewest complete rows, keeping the best selection seen
+    selected, union = [], 0
+    best_selected, best_score = [], score(0, 0)
+    remaining = set(range(len(columns)))
+    while remaining and time.time() < deadline:
+        index = max(sorted(remaining), key=lambda i: complete_rows(union | column_bits[i]))
+        remaining.remove(index)
+        selected.append(index)
+        union |= column_bits[index]
+        if score(len(selected), union) > best_score:
+            best_selected, best_score = list(selected), score(len(selected), union)
+
+    # Local search: first improving add, remove, or swap until none improves or time runs out
+    selected = set(best_selected)
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+
+        # Additions
+        union = union_of(selected)
+        for index in set(range(len(columns))) - selected:
+            if score(len(selected) + 1, union | column_bits[index]) > best_score:
+                selected.add(index)
+                best_score = score(len(selected), union | column_bits[index])
+                improved = True
+                break
+        if improved:
+            continue
+
+        # Removals and swaps
+        for removed in list(selected):
+            if time.time() >= deadline:
+                break
+            union = union_of(selected - {removed})
+            if score(len(selected) - 1, union) > best_score:
+                selected.remove(removed)
+                best_score = score(len(selected), union)
+                improved = True
+                break
+            for index in set(range(len(columns))) - selected:
+                if score(len(selected), union | column_bits[index]) > best_score:
+                    selected.remove(removed)
+                    selected.add(index)
+                    best_score = score(len(selected), union | column_bits[index])
+                    improved = True
+                    break
+            if improved:
+                break
+
+    # Features to keep
+    keep = protected.copy()
+    keep[np.array([columns[index] for index in selected], dtype=int)] = True
+
+    # Return selection, its score, the bound, and the relative gap to the bound
+    return {"keep": keep, "score": best_score, "bound": bound,
+            "gap": (bound - best_score) / float(bound) if bound > 0 else 0.0}
+
+
 # TODO: Binary encoding w/ binary NAs for categorical data and option to impute missing data
 # Automatic feature and row elimination (automatically get rid of NAs and maximize data)
 def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop_predictors=None, add_predictors=None,
                               na_elimination_n=None, print_results=False, dummy_features=None, final_features=None,
-                              balance_classes=False, data_filename="disease_modeling_data.csv"):
+                              balance_classes=False, na_elimination_step=0.025, na_elimination_search="threshold",
+                              na_elimination_time_budget=10.0, data_filename="disease_modeling_data.csv",
+                              artifact_format="parquet", export_csv=False):
     # Initiate empty list(s) when no drop/add predictors
     if drop_predictors is None:
         drop_predictors = []
@@ -333,7 +1146,7 @@ def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop
     # Account for any dummy features generated from data set
     if dummy_features is not None:
         # Convert categorical data to binary dummy columns (one hot encoding)
-        data = pd.get_dummies(data, columns=dummy_features)
+        data = observed_dummies(data, dummy_features)
 
     # Use manually selected features
     if final_features is not None:
@@ -345,56 +1158,57 @@ def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop
             if column != patient_key and column != time_key and column != outcome_measure:
                 data = data.drop(column, 1)
 
-    # Drop variables (columns) with more than N% of patients having NA at baseline and then drop patients with NAs at BL
-    def feature_row_elimination(n, test=False):
-        # Make a copy of the data
-        d = data.copy()
+    # Columns that are never eliminated
+    protected = np.array([col in add_predictors + [outcome_measure] for col in data.keys()], dtype=bool)
 
-        # Get original dimensions
-        if balance_classes:
-            original_observation_count, original_variable_count = min(len(d[d[outcome_measure] == 0].index),
-                                                                      len(d[d[outcome_measure] == 1].index)), \
-                                                                  len(d.keys())
-        else:
-            original_observation_count, original_variable_count = len(d.index), len(d.keys())
+    # Null mask and fraction of nulls per column, computed once
+    null_mask = data.isnull().values
+    null_fractions = null_mask.sum(axis=0).astype(float) / len(data.index)
+
+    # A row becomes complete once every column it is null at is eliminated, i.e. for any n below the lowest null
+    # fraction among its null columns (never, if it is null at a protected column)
+    row_thresholds = np.where(null_mask & ~protected, null_fractions, np.inf).min(axis=1)
+    row_thresholds[(null_mask & protected).any(axis=1)] = -np.inf
+
+    # Sorted row thresholds (per class if classes balanced) for counting complete rows at any n
+    if balance_classes:
+        class_thresholds = [np.sort(row_thresholds[(data[outcome_measure] == outcome_class).values])
+                            for outcome_class in [0, 1]]
+    else:
+        class_thresholds = [np.sort(row_thresholds)]
 
+    # Get original dimensions
+    if balance_classes:
+        original_observation_count, original_variable_count = min(len(thresholds) for thresholds in
+                                                                  class_thresholds), len(data.keys())
+    else:
+        original_observation_count, original_variable_count = len(data.index), len(data.keys())
+
+    # Drop variables (columns) with more than N% of patients having NA at baseline and then drop patients with NAs at BL
+    def feature_row_elimination(n):
         # Eliminate features with more than n (%) NA at BL
-        for col in d.keys():
-            if col not in add_predictors + [outcome_measure]:
-                # Processed data produces baseline-only data so checking for baseline might be redundant
-                # if time_key is not None:
-                #     if d.loc[d[time_key] == 0, col].isnull().values.sum().astype(float) / len(
-                #             d[d[time_key] == 0].index) > n:
-                #         d = d.drop(col, 1)
-                # else:
-                if d[col].isnull().values.sum().astype(float) / len(d.index) > n:
-                    d = d.drop(col, 1)
+        d = data[[col for col, is_protected, fraction in zip(data.keys(), protected, null_fractions)
+                  if is_protected or fraction <= n]]
 
+        # TODO: this should maybe only drop based on baselines
         # Drop observations with NAs at BL
-        if time_key is not None:
-            # d = d[d[patient_key].isin(d.loc[(d[time_key] == 0) & (d.notnull().all(axis=1)), patient_key])]
-            # TODO: this should maybe only drop based on baselines
-            d = d.dropna(axis=0, how='any')
-        else:
-            # d = d[d[patient_key].isin(d.loc[d.notnull().all(axis=1), patient_key])]
-            d = d.dropna(axis=0, how='any')
+        return d.dropna(axis=0, how='any')
+
+    # Score of elimination n without copying data: # of features * observations (if classes balanced, then
+    # features * (observations in smaller class)), weighed proportionally to original dimensions
+    def feature_row_elimination_score(n):
+        # Number of features kept
+        variable_count = protected.sum() + (null_fractions[~protected] <= n).sum()
+
+        # Number of complete observations (in smaller class if classes balanced)
+        observation_count = min(len(thresholds) - np.searchsorted(thresholds, n, side="right")
+                                for thresholds in class_thresholds)
 
         # Display progress
         prog.update_progress()
 
-        # Return dimensions/d
-        if test:
-            # Return # of features * observations. If classes balanced, then features * (observations in smaller class)
-            # Weighed proportionally to original dimensions
-            if balance_classes:
-                return len(d.keys()) * (min(len(d[d[outcome_measure] == 0].index),
-                                            len(d[d[outcome_measure] == 1].index)) *
-                                        (original_variable_count / original_observation_count))
-            else:
-                return len(d.keys()) * (len(d.index) * (original_variable_count / original_observation_count))
-        else:
-            # Return d
-            return d
+        # Return score
+        return variable_count * (observation_count * (original_variable_count / original_observation_count))
 
     # Print "before" dimensions
     if print_results:
@@ -409,20 +1223,42 @@ def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop
                 data.loc[data[outcome_measure] == 0, outcome_measure].size,
                 data.loc[data[outcome_measure] == 1, outcome_measure].size))
 
+    # Candidate feature elimination n's
+    if not 0 < na_elimination_step < 1:
+        raise ValueError("na_elimination_step must be between 0 and 1, got {}".format(na_elimination_step))
+    na_elimination_grid = [round(x, 10) for x in np.arange(0, 1, na_elimination_step)]
+
     # Initiate progress
-    prog = Progress(0, 41, "NA Elimination", print_results and na_elimination_n is None)
+    prog = Progress(0, len(na_elimination_grid), "NA Elimination",
+                    print_results and na_elimination_n is None and na_elimination_search == "threshold")
+
+    # Search subsets of features directly instead of a single threshold
+    if na_elimination_n is None and na_elimination_search == "subset":
+        # Search within time budget
+        subset = search_feature_subset(null_mask=null_mask, protected=protected,
+                                       class_masks=[(data[outcome_measure] == outcome_class).values
+                                                    for outcome_class in [0, 1]] if balance_classes else
+                                       [np.ones(len(data.index), dtype=bool)],
+                                       time_budget=na_elimination_time_budget)
+
+        # Print search result and gap to bound
+        if print_results:
+            print("\rNA Elimination Subset Search: {} features, {:.1%} from bound".format(subset["keep"].sum(),
+                                                                                        subset["gap"]))
 
-    # Find optimal feature elimination n
-    if na_elimination_n is None:
-        na_elimination_n = max([x / 1000 for x in range(0, 1000, 25)],
-                               key=lambda n: feature_row_elimination(n, True))
+        # Perform NA elimination with searched features
+        data = data.loc[:, subset["keep"]].dropna(axis=0, how='any')
+    else:
+        # Find optimal feature elimination n
+        if na_elimination_n is None:
+            na_elimination_n = max(na_elimination_grid, key=feature_row_elimination_score)
 
-        # Print optimal feature elimination n
-        if print_results:
-            print("\rNA Elimination N: {:.1%}".format(na_elimination_n))
+            # Print optimal feature elimination n
+            if print_results:
+                print("\rNA Elimination N: {:.1%}".format(na_elimination_n))
 
-    # Perform automatic NA elimination
-    data = feature_row_elimination(na_elimination_n)
+        # Perform automatic NA elimination
+        data = feature_row_elimination(na_elimination_n)
 
     # Print "after" dimensions
     if print_results:
@@ -460,8 +1296,8 @@ def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop
                 data.loc[data[outcome_measure] == 0, outcome_measure].size,
                 data.loc[data[outcome_measure] == 1, outcome_measure].size))
 
-    # Create csv
-    data.to_csv(data_filename, index=False)
+    # Create artifact
+    write_artifact(data, data_filename, artifact_format, export_csv)
 
     # Return data
     return data.copy()
@@ -470,7 +1306,8 @@ def eliminate_nulls_maximally(data, patient_key, time_key, outcome_measure, drop
 # Train and optimize a model with grid search
 def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=None, add_predictors=None,
           do_grid_search=False, feature_importance_min=0.01, print_results=True, output_results=True, n_jobs=-1,
-          optimize_precision=False, results_filename="results.csv"):
+          optimize_precision=False, split_random_state=None, search_strategy="grid", search_budget=None,
+          search_cache_dir=None, results_filename="results.csv"):
     # Initiate empty list(s) when no drop/add predictors
     if drop_predictors is None:
         drop_predictors = []
@@ -488,7 +1325,7 @@ def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=
     dummy_features = [item for item in data.columns.values if item not in list(
         data.select_dtypes(include=numerics).columns.values) + drop_predictors]
     # Dropping one!
-    data = pd.get_dummies(data, columns=dummy_features, drop_first=True)
+    data = observed_dummies(data, dummy_features, drop_first=True)
 
     # Initialize training data
     training_data = data.copy()
@@ -563,8 +1400,8 @@ def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=
         grid_search = mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
                                  alg_names=alg_names, n_jobs=n_jobs,
                                  scoring="r2" if is_regressor else precision_scorer if optimize_precision else "accuracy",
-                                 grid_search_params=grid_search_params,
-                                 print_results=True)
+                                 grid_search_params=grid_search_params, search_strategy=search_strategy,
+                                 search_budget=search_budget, search_cache_dir=search_cache_dir, print_results=True)
 
         # Get best estimator
         grid_search_estimator = grid_search["Grid Search Random Forest"].best_estimator_
@@ -596,46 +1433,25 @@ def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=
     # Precision scorer
     precision_scorer = make_scorer(precision_score, pos_label=0, average="binary")
 
-    # Display metrics, including r2 score
-    metrics.update(mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
-                              alg_names=alg_names, cross_val=[print_results or output_results],
-                              scoring="r2", print_results=print_results, description=None))
-
-    if optimize_precision:
-        # Display precision score
-        metrics.update(mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
-                                  alg_names=alg_names, cross_val=[print_results or output_results],
-                                  scoring=precision_scorer, description=None, print_results=print_results))
-
-    # Display mean absolute error score
-    metrics.update(mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
-                              alg_names=alg_names, cross_val=[print_results or output_results],
-                              scoring="neg_mean_absolute_error", description=None, print_results=print_results))
+    # Initialize accuracy metric
+    metrics["Cross Validation accuracy Random Forest"] = None
+    metrics["Cross Validation {} Random Forest".format(precision_scorer)] = None
 
-    # Display root mean squared error score
+    # Display r2, precision, mean absolute error, root mean squared error, and classification accuracy scores, all
+    # computed from the same cross validation fits
     metrics.update(mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
                               alg_names=alg_names, cross_val=[print_results or output_results],
-                              scoring="root_mean_squared_error", description=None, print_results=print_results))
-
-    # Initialize accuracy metric
-    metrics["Cross Validation accuracy Random Forest"] = None
-    metrics["Cross Validation make_scorer(precision_score, average=binary, pos_label=0) Random Forest"] = None
+                              scoring=["r2"] + ([precision_scorer] if optimize_precision else []) +
+                                      ["neg_mean_absolute_error", "root_mean_squared_error"] +
+                                      ([] if is_regressor else ["accuracy"]),
+                              print_results=print_results, description=None))
 
     # If classifier
     if not is_regressor:
-        # Display classification accuracy
-        metrics.update(mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs,
-                                  alg_names=alg_names, cross_val=[True], scoring="accuracy", description=None,
-                                  print_results=print_results))
-
-        # Display classification report
-        mL.metrics(data=data, predictors=predictors, target=outcome_measure, algs=algs, alg_names=alg_names,
-                   split_classification_report=[True], description=None, print_results=print_results)
-
-        # Display confusion matrix
+        # Display classification report and confusion matrix from the same split and fit
         mL.metrics(data=data[predictors + [outcome_measure]], predictors=predictors, target=outcome_measure,
-                   algs=algs, alg_names=alg_names, split_confusion_matrix=[True], description=None,
-                   print_results=print_results)
+                   algs=algs, alg_names=alg_names, split_classification_report=[True], split_confusion_matrix=[True],
+                   split_random_state=split_random_state, description=None, print_results=print_results)
 
     # Get feature importances
     feature_importances = metrics["Feature Importances Random Forest"]
@@ -661,8 +1477,7 @@ def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=
         results.loc[0, "mae"] = metrics["Cross Validation neg_mean_absolute_error Random Forest"]
         results.loc[0, "rmse"] = metrics["Cross Validation root_mean_squared_error Random Forest"]
         results.loc[0, "accuracy"] = metrics["Cross Validation accuracy Random Forest"]
-        results.loc[0, "precision"] = metrics[
-            "Cross Validation make_scorer(precision_score, average=binary, pos_label=0) Random Forest"]
+        results.loc[0, "precision"] = metrics["Cross Validation {} Random Forest".format(precision_scorer)]
         feature_importances = list(metrics["Feature Importances Random Forest"])
         results.loc[0, "features"] = feature_importances[0][0]
         results.loc[0, "importances"] = feature_importances[0][1]
@@ -683,6 +1498,70 @@ def model(data, model_type, outcome_measure, is_regressor=True, drop_predictors=
     return model_results
 
 
+# Generate IS_TREATED (1 from a patient's first symptomatic therapy (ST) visit date onward, else 0)
+def generate_treatment_status(data, id_name, event_name, datetime_name, treatment_event="ST"):
+    # Parse visit dates once
+    dates = pd.to_datetime(data[datetime_name])
+
+    # Date of each patient's first ST visit
+    treatment_mask = data[event_name] == treatment_event
+    treatment_dates = pd.DataFrame({id_name: data.loc[treatment_mask, id_name],
+                                    "TREATMENT_DATE": dates[treatment_mask]}).drop_duplicates(subset=[id_name])
+    treatment_dates = dict(zip(treatment_dates[id_name], treatment_dates["TREATMENT_DATE"]))
+
+    # Treated wherever the visit is on or after the patient's ST date (never for patients without an ST visit)
+    data = data.copy()
+    data.loc[:, "IS_TREATED"] = (dates >= pd.to_datetime(data[id_name].map(treatment_dates))).astype(int)
+
+    # Return data
+    return data
+
+
+# Sums of families of scale items (e.g. the parts of the UPDRS, or MoCA or SCOPA domains) as one matrix product of the
+# item values and a family indicator matrix, with the column index map precompiled once per column layout
+class ItemAggregator:
+    def __init__(self, item_families):
+        # {family: [item columns]}
+        self.item_families = item_families
+        self.items = list(dict.fromkeys(item for items in item_families.values() for item in items))
+
+        # Compiled column indices and indicator matrices by column layout
+        self.compiled = {}
+
+    def present_items(self, columns):
+        # Items of any family that are columns
+        columns = set(columns)
+        return [item for item in self.items if item in columns]
+
+    def compile(self, columns):
+        # Positions of the present items and their (items x families) indicator matrix
+        key = tuple(columns)
+        if key not in self.compiled:
+            positions = dict((column, index) for index, column in enumerate(columns))
+            items = self.present_items(columns)
+            indicator = np.zeros((len(items), len(self.item_families)))
+            for family_index, family_items in enumerate(self.item_families.values()):
+                for item_index, item in enumerate(items):
+                    indicator[item_index, family_index] = item in family_items
+            self.compiled[key] = (np.array([positions[item] for item in items], dtype=int), indicator)
+        return self.compiled[key]
+
+    def aggregate(self, data):
+        # Sum each family's items (missing values count as 0, like pandas' sum)
+        indices, indicator = self.compile(list(data.columns))
+        values = np.ascontiguousarray(data.iloc[:, indices].to_numpy(dtype=float))
+        return pd.DataFrame(np.nan_to_num(values) @ indicator, index=data.index, columns=list(self.item_families))
+
+
+# UPDRS part items (PN3RIGRL, a misspelled rigidity item in the raw data, was never counted in UPDRS_III and is left out)
+updrs_aggregator = ItemAggregator({
+    "UPDRS_I": ["NP1COG", "NP1HALL", "NP1DPRS", "NP1ANXS", "NP1APAT", "NP1DDS", "NP1SLPN", "NP1SLPD", "NP1PAIN",
+                "NP1URIN", "NP1CNST", "NP1LTHD", "NP1FATG"],
+    "UPDRS_II": ["NP2SPCH", "NP2SALV", "NP2SWAL", "NP2EAT", "NP2DRES", "NP2HYGN", "NP2HWRT", "NP2HOBB", "NP2TURN",
+                 "NP2TRMR", "NP2RISE", "NP2WALK", "NP2FREZ"],
+    "UPDRS_III": [item for item in updrs_part_iii_items if item.startswith("NP3")]})
+
+
 # Generate UPDRS_I, UPDRS_II, and UPDRS_III
 def generate_updrs_subsets(data, features):
     # set features
@@ -692,9 +1571,9 @@ def generate_updrs_subsets(data, features):
             features.append(feature)
 
     # Sum UPDRS subsets
-    data.loc[:, "UPDRS_I"] = data.filter(regex="NP1.*").sum(axis=1)
-    data.loc[:, "UPDRS_II"] = data.filter(regex="NP2.*").sum(axis=1)
-    data.loc[:, "UPDRS_III"] = data.filter(regex="NP3.*").sum(axis=1)
+    subsets = updrs_aggregator.aggregate(data)
+    for subset in subsets.columns:
+        data.loc[:, subset] = subsets[subset]
     data.loc[:, "UPDRS_II_AND_III"] = data["UPDRS_II"] + data["UPDRS_III"]
 
     # Return new data
@@ -711,48 +1590,122 @@ def generate_time(data, features, id_name, time_name, datetime_name, birthday_na
             features.append(feature)
 
     # Drop rows with no date time
-    data = data[data[datetime_name].notnull()]
+    data = data[data[datetime_name].notnull()].copy()
 
-    # Initialize columns
-    data.loc[:, "TIME_FROM_BL"] = -1
-    data.loc[:, "AGE"] = -1
-    data.loc[:, "TIME_SINCE_DIAGNOSIS"] = -1
-    data.loc[:, "TIME_SINCE_FIRST_SYMPTOM"] = -1
+    # Initialize progress measures
+    prog = Progress(0, 1, "Generating Times", progress)
 
-    # Convert dates to date times
-    data.loc[:, datetime_name] = pd.to_datetime(data[datetime_name])
-    data.loc[:, birthday_name] = pd.to_datetime(data[birthday_name])
-    data.loc[:, datetime_name] = pd.to_datetime(data[datetime_name])
-    data.loc[:, diagnosis_date_name] = pd.to_datetime(data[diagnosis_date_name])
-    data.loc[:, first_symptom_date_name] = pd.to_datetime(data[first_symptom_date_name])
+    # Convert dates to date times (once each)
+    for date_name in [datetime_name, birthday_name, diagnosis_date_name, first_symptom_date_name]:
+        data[date_name] = pd.to_datetime(data[date_name])
 
-    # Initialize progress measures
-    prog = Progress(0, len(data[id_name].unique()), "Generating Times", progress)
+    # Years between two date time columns
+    def years_between(later, earlier):
+        return (later - earlier) / np.timedelta64(1, 'D') / 365
 
-    # Set time from baseline
-    for data_id in data[id_name].unique():
-        # Set time from BL
-        now_date = data.loc[data[id_name] == data_id, datetime_name]
-        baseline_date = data.loc[(data[id_name] == data_id) & (data[time_name] == 0), datetime_name].min()
-        data.loc[data[id_name] == data_id, "TIME_FROM_BL"] = (now_date - baseline_date).apply(
-            lambda x: (x / np.timedelta64(1, 'D')) / 365)
+    # Set time from baseline (each patient's earliest baseline date)
+    baseline_dates = data[datetime_name].where(data[time_name] == 0).groupby(data[id_name]).transform("min")
+    data["TIME_FROM_BL"] = years_between(data[datetime_name], baseline_dates)
 
-        # Update progress
-        prog.update_progress()
+    # Set age in years, years from diagnosis, and years from first symptom (only for patients with PD)
+    has_pd = data["HAS_PD"] == 1
+    data["AGE"] = years_between(data[datetime_name], data[birthday_name])
+    data["TIME_SINCE_DIAGNOSIS"] = years_between(data[datetime_name], data[diagnosis_date_name]).where(has_pd, -1)
+    data["TIME_SINCE_FIRST_SYMPTOM"] = years_between(data[datetime_name], data[first_symptom_date_name]).where(
+        has_pd, -1)
 
-    # Set age in years, years from diagnosis, and years from first symptom
-    data.loc[:, "AGE"] = (data[datetime_name] - data[birthday_name]).apply(lambda x: (x / np.timedelta64(1, 'D')) / 365)
-    data.loc[data["HAS_PD"] == 1, "TIME_SINCE_DIAGNOSIS"] = (
-        data.loc[data["HAS_PD"] == 1, datetime_name] - data.loc[data["HAS_PD"] == 1, diagnosis_date_name]).apply(
-        lambda x: (x / np.timedelta64(1, 'D')) / 365)
-    data.loc[data["HAS_PD"] == 1, "TIME_SINCE_FIRST_SYMPTOM"] = (
-        data.loc[data["HAS_PD"] == 1, datetime_name] - data.loc[data["HAS_PD"] == 1, first_symptom_date_name]).apply(
-        lambda x: (x / np.timedelta64(1, 'D')) / 365)
+    # Update progress
+    prog.update_progress()
 
     # Return data
     return data
 
 
+# Derived features of the preprocessed data: outputs, declared input columns (or a function of the available columns
+# choosing them), and a generator from a frame of the inputs to a frame of the outputs
+feature_definitions = {
+    "updrs_subsets": {"outputs": ["UPDRS_I", "UPDRS_II", "UPDRS_III", "UPDRS_II_AND_III"],
+                      "inputs": updrs_aggregator.present_items,
+                      "generate": lambda data: generate_updrs_subsets(data=data.copy(), features=[])},
+    "times": {"outputs": ["TIME_FROM_BL", "AGE", "TIME_SINCE_DIAGNOSIS", "TIME_SINCE_FIRST_SYMPTOM"],
+              "inputs": ["PATNO", "EVENT_ID", "INFODT", "BIRTHDT.x", "PDDXDT", "SXDT", "HAS_PD"],
+              "generate": lambda data: generate_time(data=data, features=[], id_name="PATNO", time_name="EVENT_ID",
+                                                     datetime_name="INFODT", birthday_name="BIRTHDT.x",
+                                                     diagnosis_date_name="PDDXDT", first_symptom_date_name="SXDT",
+                                                     progress=False)}}
+
+# Generated feature frames memoized by definition and fingerprint of their inputs, least recently used first (at most
+# feature_memo_size frames, shared by the threads generating definitions)
+feature_memo = OrderedDict()
+feature_memo_size = 8
+feature_memo_lock = threading.Lock()
+
+
+# Generate the derived features reachable from the requested features (all if None), lazily: only definitions with a
+# requested output (or an output needed by one) are computed, independent definitions in parallel. With memoize, each
+# definition's outputs are memoized (worth the hashing of its inputs only when the same data is generated repeatedly).
+def generate_features(data, features, requested=None, progress=False, n_jobs=None, memoize=False):
+    # Definition producing each derived feature
+    producers = dict((output, name) for name, definition in feature_definitions.items()
+                     for output in definition["outputs"])
+
+    # Input columns of a definition
+    def inputs(name):
+        declared = feature_definitions[name]["inputs"]
+        return declared(list(data.columns)) if callable(declared) else declared
+
+    # Depth of each reachable definition in the dependency graph (inputs that are derived features come first)
+    depths = {}
+
+    def visit(name):
+        if name not in depths:
+            depths[name] = 1 + max([visit(producers[column]) for column in inputs(name) if column in producers] or
+                                   [-1])
+        return depths[name]
+
+    for feature in (list(producers) if requested is None else requested):
+        if feature in producers:
+            visit(producers[feature])
+
+    # Initialize progress measures
+    prog = Progress(0, len(depths), "Generating Features", progress)
+
+    # Outputs of a definition (memoized by the fingerprint of its inputs)
+    def generate(name):
+        columns = inputs(name)
+        key = (name, mL.fingerprint(columns, data[columns])) if memoize else None
+        with feature_memo_lock:
+            outputs = feature_memo.get(key)
+            if outputs is not None:
+                feature_memo.move_to_end(key)
+                outputs = outputs.copy()
+        if outputs is None:
+            outputs = feature_definitions[name]["generate"](data[columns])
+            outputs = outputs[feature_definitions[name]["outputs"]].reindex(data.index).reset_index(drop=True)
+            if memoize:
+                with feature_memo_lock:
+                    feature_memo[key] = outputs.copy()
+                    while len(feature_memo) > feature_memo_size:
+                        feature_memo.popitem(last=False)
+        outputs.index = data.index
+        return outputs
+
+    # Generate definitions depth by depth, those at the same depth in parallel
+    for depth in sorted(set(depths.values())):
+        names = [name for name in depths if depths[name] == depth]
+        with ThreadPoolExecutor(max_workers=n_jobs or len(names)) as executor:
+            for outputs in executor.map(generate, names):
+                data = data.assign(**dict((column, outputs[column]) for column in outputs.columns))
+                for column in outputs.columns:
+                    if column not in features:
+                        features.append(column)
+
+                # Update progress
+                prog.update_progress()
+
+    # Return data
+    return data
+
 # # Generate future scores
 # def generate_future_score(data, features, id_name, score_name, time_name, progress):
 #     # Set features
@@ -795,51 +1748,61 @@ def generate_time(data, features, id_name, time_name, datetime_name, birthday_na
 #     return new_data[(new_data["TIME_FUTURE"] >= 0) & (new_data["TIME_FUTURE"] <= 24)]
 
 # Generate future scores
-def generate_future_score(data, features, id_name, score_name, time_name, progress, time_from, time_until):
+def generate_future_score(data, features, id_name, score_name, time_name, progress, time_from, time_until,
+                          chunk_size=500):
     # Set features
     new_features = ["SCORE_NOW", "TIME_NOW", "TIME_FUTURE", "TIME_PASSED", "SCORE_FUTURE"]
     for feature in new_features:
         if feature not in features:
             features.append(feature)
 
+    # Number patients by first appearance (before removing rows, as map_patient_partitions does) and rows by position
+    data = data.assign(ORDER_PATIENT=pd.factorize(data[id_name])[0], ORDER_NOW=np.arange(len(data.index)))
+
     # Remove rows without score
     data = data[data[score_name].notnull()]
 
-    # Initialize the new dataset
-    new_data = pd.DataFrame(columns=features)
+    # Assign patients to chunks of at most chunk_size patients (bounds the size of each self-join)
+    chunk_ids = data["ORDER_PATIENT"].values // chunk_size
 
     # Initialize progress measures
-    prog = Progress(0, len(data.index), "Generating Futures", progress)
-
-    # For each observation
-    for index, observation in data.iterrows():
-        # Get time of observation
-        time_now = observation.at[time_name]
-
-        # Get patient id
-        patient_id = observation.at[id_name]
+    prog = Progress(0, len(np.unique(chunk_ids)), "Generating Futures", progress)
 
-        # Get future data for specified time frame relative to this observation
-        futures = data[(data[id_name] == patient_id) & (data[time_name] > time_now + time_from) &
-                           (data[time_name] <= time_now + time_until)][[id_name, time_name, score_name]]
-        futures.rename(columns={time_name: "TIME_FUTURE", score_name: "SCORE_FUTURE"}, inplace=True)
+    # Pairs of (now, future) observations for each chunk
+    chunk_pairs = []
+    for chunk_id, chunk in data.groupby(chunk_ids, sort=True):
+        # Future scores of the chunk's patients
+        futures = chunk[[id_name, time_name, score_name, "ORDER_NOW"]].rename(
+            columns={time_name: "TIME_FUTURE", score_name: "SCORE_FUTURE", "ORDER_NOW": "ORDER_FUTURE"})
 
-        # If data available
-        if not futures.empty:
-            # Add future information to observation
-            observation_futures = futures.merge(pd.DataFrame([observation]), on=[id_name], how="left")
+        # Join every observation with every observation of the same patient
+        pairs = chunk.merge(futures, on=id_name, how="inner")
 
-            # Calculate time passed
-            observation_futures["TIME_PASSED"] = observation_futures["TIME_FUTURE"] - time_now
+        # Keep futures inside the specified time frame relative to each observation
+        pairs = pairs[(pairs["TIME_FUTURE"] > pairs[time_name] + time_from) &
+                      (pairs["TIME_FUTURE"] <= pairs[time_name] + time_until)]
 
-            # Append to the new dataset
-            new_data = new_data.append(observation_futures, ignore_index=True)
+        chunk_pairs.append(pairs)
 
         # Update progress
         prog.update_progress()
 
+    # If no data available
+    if not chunk_pairs:
+        return pd.DataFrame(columns=features)
+
+    # Combine chunks, ordered by patient (by first appearance), then by observation, then by future (the order of
+    # the previous per-observation loop when each patient's rows are contiguous, and the order of map_patient_partitions)
+    new_data = pd.concat(chunk_pairs, ignore_index=True).sort_values(["ORDER_PATIENT", "ORDER_NOW", "ORDER_FUTURE"],
+                                                                     kind="mergesort", ignore_index=True)
+
+    # Set now information and calculate time passed
+    new_data["SCORE_NOW"] = new_data[score_name]
+    new_data["TIME_NOW"] = new_data[time_name]
+    new_data["TIME_PASSED"] = new_data["TIME_FUTURE"] - new_data["TIME_NOW"]
+
     # Return new dataset
-    return new_data
+    return new_data.reindex(columns=features)
 
 
 # Generate time until symptom onsets
@@ -850,62 +1813,150 @@ def generate_time_until_symptom_onset(data, features, id_name, time_name, condit
         if feature not in features:
             features.append(feature)
 
-    # Create new dataframe
-    new_data = pd.DataFrame(columns=features)
-
     # Initialize progress measures
-    prog = Progress(0, len(data), "Generating Milestones", progress)
-
-    # Iterate through rows and build new data (generate TIME_NOW, TIME_OF_MILESTONE, and TIME_UNTIL_MILESTONE)
-    for index, row in data.iterrows():
-        # Set ID
-        data_id = row[id_name]
+    prog = Progress(0, 1, "Generating Milestones", progress)
 
-        # Set time now
-        time_now = row[time_name]
+    # Evaluate the milestone condition once for all observations
+    onset_data = data.loc[np.asarray(condition(data), dtype=bool), [id_name, time_name]]
 
-        # Check time value(s) and make sure the condition is met for a sample with this ID
-        if time_now == 0 and any(data.loc[(data[id_name] == data_id) & (condition(data)), time_name]):
-            # Time of milestone
-            time_of_milestone = data.loc[(data[id_name] == data_id) & (condition(
-                data)), time_name].min()
+    # First milestone time of each patient (patients whose milestones are all at time 0 are excluded, as before)
+    has_onset = (onset_data[time_name] != 0).groupby(onset_data[id_name]).any()
+    time_of_milestone = onset_data.groupby(id_name)[time_name].min()[has_onset]
 
-            # Time until milestone from time now
-            time_until_milestone = time_of_milestone - time_now
+    # Baseline rows of patients who reach the milestone
+    new_data = data[(data[time_name] == 0) & data[id_name].isin(time_of_milestone.index)].copy()
 
-            # Set features
-            row["TIME_NOW"] = time_now
-            row["TIME_OF_MILESTONE"] = time_of_milestone
-            row["TIME_UNTIL_MILESTONE"] = time_until_milestone
+    # Set features (generate TIME_NOW, TIME_OF_MILESTONE, and TIME_UNTIL_MILESTONE)
+    new_data["TIME_NOW"] = new_data[time_name]
+    new_data["TIME_OF_MILESTONE"] = new_data[id_name].map(time_of_milestone)
+    new_data["TIME_UNTIL_MILESTONE"] = new_data["TIME_OF_MILESTONE"] - new_data["TIME_NOW"]
 
-            # Add row to new_data
-            if not math.isnan(new_data.index.max()):
-                new_data.loc[new_data.index.max() + 1] = row[features]
-            else:
-                new_data.loc[0] = row[features]
-
-        # Update progress
-        prog.update_progress()
+    # Update progress
+    prog.update_progress()
 
     # Return new data
-    return new_data
+    return new_data.reset_index(drop=True).reindex(columns=features)
+
+
+# Per-patient simple linear regressions (same results as scipy.stats.linregress) computed from grouped sums
+def linear_regressions(data, id_name, x_name, y_name):
+    # Group by patient
+    x = data[x_name].astype(float)
+    y = data[y_name].astype(float)
+    groups = data[id_name]
+
+    # Center on per-patient means (keeps the sums of squares numerically stable)
+    n = x.groupby(groups).count()
+    x_mean = x.groupby(groups).mean()
+    y_mean = y.groupby(groups).mean()
+    x_centered = x - groups.map(x_mean)
+    y_centered = y - groups.map(y_mean)
+
+    # Population (co)variances from grouped sums
+    ssxm = (x_centered ** 2).groupby(groups).sum() / n
+    ssym = (y_centered ** 2).groupby(groups).sum() / n
+    ssxym = (x_centered * y_centered).groupby(groups).sum() / n
+
+    # Correlation coefficient (undefined for a constant x or y, as in scipy.stats.linregress)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r_den = np.sqrt(ssxm * ssym)
+        r_value = (ssxym / r_den).where(r_den != 0, np.nan).clip(-1.0, 1.0)
+
+        # Slope and intercept
+        slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+
+        # P value (two-sided t test) and standard error of the slope
+        df = n - 2
+        tiny = 1.0e-20
+        t = r_value * np.sqrt(df / ((1.0 - r_value + tiny) * (1.0 + r_value + tiny)))
+        p_value = pd.Series(2 * scipy.stats.t.sf(np.abs(t), df), index=n.index)
+        std_err = np.sqrt((1 - r_value ** 2) * ssym / ssxm / df)
+
+    # Two observations always fit perfectly
+    p_value[n == 2] = np.where(ssym[n == 2] == 0, 1.0, 0.0)
+    std_err[n == 2] = 0.0
+
+    # Regressions
+    regressions = pd.DataFrame({"slope": slope, "intercept": intercept, "r_value": r_value, "p_value": p_value,
+                                "std_err": std_err, "n": n})
+
+    # Patients with a constant x have no regression (scipy.stats.linregress raises)
+    regressions.loc[ssxm == 0, ["slope", "intercept", "r_value", "p_value", "std_err"]] = np.nan
+
+    # Patients with missing values have no regression
+    has_null = (x.isnull() | y.isnull()).groupby(groups).any()
+    regressions.loc[has_null, ["slope", "intercept", "r_value", "p_value", "std_err"]] = np.nan
+
+    # Return regressions
+    return regressions
+
+
+# Fit a linear mixed-effects model w/ random slopes/random intercepts, cached on disk by data content and formula
+def fit_lme(data, id_name, time_name, score_name, cache_dir=None):
+    # Model formulas
+    formula = "{} ~ {}".format(score_name, time_name)
+    re_formula = "~" + time_name
+
+    # Fit without cache
+    if cache_dir is None:
+        lme_fit = sm.MixedLM.from_formula(formula, data, re_formula=re_formula, groups=data[id_name]).fit()
+        return {"random_effects": pd.DataFrame.from_dict(lme_fit.random_effects, "index"),
+                "fixed_effects": lme_fit.fe_params}
+
+    # Cache files are named by formulas, dimensions, and a content hash of the modeled columns, so that a warm start
+    # can be found from the file names alone
+    formula_key = hashlib.sha1("{}|{}|{}".format(id_name, formula, re_formula).encode("utf-8")).hexdigest()[:16]
+    n_observations, n_groups = len(data.index), data[id_name].nunique()
+    key = hashlib.sha1(pd.util.hash_pandas_object(data[[id_name, time_name, score_name]], index=False).values)
+    cache_path = os.path.join(cache_dir, "{}_{}_{}_{}.pkl".format(formula_key, n_observations, n_groups,
+                                                                  key.hexdigest()))
+
+    # Load cached fit
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as cache_file:
+            cached = pickle.load(cache_file)
+        return {"random_effects": cached["random_effects"], "fixed_effects": cached["fixed_effects"]}
+
+    # Warm start from the cached fit of the same formulas with the most similar dimensions
+    nearest, nearest_filename, nearest_distance = None, None, None
+    for filename in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        parts = filename[:-len(".pkl")].split("_") if filename.endswith(".pkl") else []
+        if len(parts) == 4 and parts[0] == formula_key:
+            distance = abs(int(parts[1]) - n_observations) + abs(int(parts[2]) - n_groups)
+            if nearest_distance is None or distance < nearest_distance:
+                nearest_filename, nearest_distance = filename, distance
+    if nearest_filename is not None:
+        with open(os.path.join(cache_dir, nearest_filename), "rb") as cache_file:
+            nearest = pickle.load(cache_file)
+
+    # Fit lme model
+    lme = sm.MixedLM.from_formula(formula, data, re_formula=re_formula, groups=data[id_name])
+    lme_fit = lme.fit() if nearest is None else lme.fit(start_params=nearest["params"])
+
+    # Cache fit
+    cached = {"params": lme_fit.params_object, "fixed_effects": lme_fit.fe_params,
+              "random_effects": pd.DataFrame.from_dict(lme_fit.random_effects, "index")}
+    mL.dump_atomic(cached, cache_path)
+
+    # Return random and fixed effects
+    return {"random_effects": cached["random_effects"], "fixed_effects": cached["fixed_effects"]}
 
 
 # Generate rates of progression
 def generate_rate_of_progression(data, id_name, time_name, score_name, target, progress, min_duration=None,
-                                 max_duration=None, min_observations=3, cutoff=None, post_lme_data=None):
+                                 max_duration=None, min_observations=3, cutoff=None, post_lme_data=None,
+                                 lr_statistics=False, lme_cache_dir=None):
     # Only include patients with at least two years of data
     if min_duration is not None:
-        data = data[data[id_name].isin(data.loc[data[time_name] >= min_duration, id_name].unique())]
+        data = filter_min_duration(data=data, id_name=id_name, time_name=time_name, min_duration=min_duration)
 
     # Only include up to a certain duration of data
     if max_duration is not None:
         data = data[data[time_name] <= max_duration]
 
     # Only include patients with at least a certain number of observations
-    for subject in data[id_name].unique():
-        if len(data[data[id_name] == subject]) < min_observations:
-            data = data[data[id_name] != subject]
+    data = filter_min_observations(data=data, id_name=id_name, min_observations=min_observations)
 
     # If linear mixed effects model
     if target == "RATE_LME_CONTINUOUS" \
@@ -914,20 +1965,17 @@ def generate_rate_of_progression(data, id_name, time_name, score_name, target, p
             or target == "RATE_LME_DISCRETE" \
             or target == "RATE_LME_TX_VS_NO_TX_CONTINUOUS" \
             or target == "RATE_LME_INCLUSION_EXCLUSION_MAN":
-        # Output pre-LME data
-        data.to_csv("data/output/pre_LME_data.csv", index=False)
+        # Output pre-LME data (always csv, the handoff to the R LME framework)
+        write_artifact(data, "data/output/pre_LME_data.csv", "csv")
 
         # If LME data not already provided
         if post_lme_data is None:
-            # Linear mixed-effects model w/ random slopes/random intercepts
-            lme = sm.MixedLM.from_formula("{} ~ {}".format(score_name, time_name), data, re_formula="~" + time_name,
-                                          groups=data[id_name])
-
-            # Fit lme model
-            lme_fit = lme.fit()
+            # Linear mixed-effects model w/ random slopes/random intercepts (loaded from cache when already fit)
+            lme_fit = fit_lme(data=data, id_name=id_name, time_name=time_name, score_name=score_name,
+                              cache_dir=lme_cache_dir)
 
             # Lme results
-            lme_result = pd.DataFrame.from_dict(lme_fit.random_effects, "index").drop("Intercept", 1)
+            lme_result = lme_fit["random_effects"].drop(columns="Intercept")
         else:
             lme_result = post_lme_data[[id_name, time_name]]
 
@@ -1010,28 +2058,28 @@ def generate_rate_of_progression(data, id_name, time_name, score_name, target, p
             or target == "RATE_LR_INCLUSION_EXCLUSION_FAST" \
             or target == "RATE_LR_CONTINUOUS":
         # Initialize progress measures
-        prog = Progress(0, len(data[id_name].unique()), "Rate Linear Regression", progress)
+        prog = Progress(0, 1, "Rate Linear Regression", progress)
 
-        # Iterate through patients
-        for data_id in data[id_name].unique():
-            # Variables for linear regression
-            x_var = data.loc[data[id_name] == data_id, time_name]
-            y_var = data.loc[data[id_name] == data_id, score_name]
+        # Linear regression of every patient at once
+        regressions = linear_regressions(data=data, id_name=id_name, x_name=time_name, y_name=score_name)
 
-            # Linear regression
-            slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x_var, y_var)
+        # Only use baseline data
+        data = data[data[time_name] == 0].copy()
 
-            # Set features
-            data.loc[(data[id_name] == data_id) & (data[time_name] == 0), "RATE_LR_CONTINUOUS"] = slope
-            data.loc[(data[id_name] == data_id) & (data[time_name] == 0), "TIME_NOW"] = 0
-            data.loc[(data[id_name] == data_id) & (data[time_name] == 0), "SCORE_NOW"] = data.loc[
-                (data[id_name] == data_id) & (data[time_name] == 0), score_name]
+        # Set features
+        data.loc[:, "RATE_LR_CONTINUOUS"] = data[id_name].map(regressions["slope"])
+        data.loc[:, "TIME_NOW"] = 0
+        data.loc[:, "SCORE_NOW"] = data[score_name]
 
-            # Update progress
-            prog.update_progress()
+        # Set optional regression statistics
+        if lr_statistics:
+            data.loc[:, "RATE_LR_INTERCEPT"] = data[id_name].map(regressions["intercept"])
+            data.loc[:, "RATE_LR_R_VALUE"] = data[id_name].map(regressions["r_value"])
+            data.loc[:, "RATE_LR_P_VALUE"] = data[id_name].map(regressions["p_value"])
+            data.loc[:, "RATE_LR_STD_ERR"] = data[id_name].map(regressions["std_err"])
 
-        # Only use baseline data
-        data = data[data[time_name] == 0]
+        # Update progress
+        prog.update_progress()
 
         # Get tertiles
         tertile_1 = np.percentile(data["RATE_LR_CONTINUOUS"], 33 + 1 / 3)
@@ -1128,7 +2176,7 @@ def stats(histogram=None, bar=None, show=True):
 
 
 # Histograms of rate frequencies for LME using data of all patients vs of PD patients, compared with LR
-def histograms_rate_lme_types_lr(patient_key, time_key, base_target, drop_predictors=None):
+def histograms_rate_lme_types_lr(patient_key, time_key, base_target, drop_predictors=None, lme_cache_dir=None):
     # Initiate empty list when no drop predictors
     if drop_predictors is None:
         drop_predictors = []
@@ -1155,7 +2203,7 @@ def histograms_rate_lme_types_lr(patient_key, time_key, base_target, drop_predic
     processed_data_pd_rate_lme = process_data(preprocessed_data_pd, model_type, patient_key, time_key, base_target,
                                               outcome_measure, drop_predictors, print_results=True, output_file=True,
                                               data_filename="data/output/processed_{}_{}.csv".format(
-                                                  filename_suffix, outcome_measure))
+                                                  filename_suffix, outcome_measure), lme_cache_dir=lme_cache_dir)
 
     # Suffix of file output names
     filename_suffix = "pd_control_data"
@@ -1172,7 +2220,8 @@ def histograms_rate_lme_types_lr(patient_key, time_key, base_target, drop_predic
                                                       base_target, outcome_measure, drop_predictors, print_results=True,
                                                       output_file=True,
                                                       data_filename="data/output/processed_{}_{}.csv".format(
-                                                          filename_suffix, outcome_measure))
+                                                          filename_suffix, outcome_measure),
+                                                      lme_cache_dir=lme_cache_dir)
 
     # Change outcome measure to linear regression
     outcome_measure = "RATE_LR_CONTINUOUS"
@@ -1184,7 +2233,7 @@ def histograms_rate_lme_types_lr(patient_key, time_key, base_target, drop_predic
     processed_data_pd_rate_lr = process_data(preprocessed_data_pd, model_type, patient_key, time_key, base_target,
                                              outcome_measure, drop_predictors, print_results=True, output_file=True,
                                              data_filename="data/output/processed_{}_{}.csv".format(
-                                                 filename_suffix, outcome_measure))
+                                                 filename_suffix, outcome_measure), lme_cache_dir=lme_cache_dir)
 
     # Stats on rates
     stats(histogram={"info": [
@@ -1264,7 +2313,9 @@ def run(patient_key, time_key, model_type, is_regressor, base_target, outcome_me
         drop_predictors=None, on_off_dose="off", treated_untreated="treated_and_untreated", cutoff=None,
         balance_classes=False, data_merged_sc_into_bl_file_path=None, do_grid_search=False, no_nulls_data=None,
         processed_data=None, preprocessed_data=None, cohorts=None, time_from=0.0, time_until=0.2,
-        post_lme_data=None, na_elimination_n=None, optimize_precision=False, feature_importance_min=0.01):
+        post_lme_data=None, na_elimination_n=None, optimize_precision=False, feature_importance_min=0.01,
+        stage_cache_dir=None, artifact_format="parquet", export_csv=False, n_partitions=None, n_jobs=None,
+        search_cache_dir=None, stage_cache_max_bytes=2 ** 30, lme_cache_dir=None):
     # Print run details
     print("\nRUN DETAILS\n")
     print("Model type: {}\n"
@@ -1294,6 +2345,17 @@ def run(patient_key, time_key, model_type, is_regressor, base_target, outcome_me
     if cohorts is None:
         cohorts = ["PD"]
 
+    # Raw data read by preprocess_data (fingerprinted by the stage cache, when there is one)
+    raw_data_filenames = [schema["filename"] for schema in raw_data_schemas.values()] + (
+        [resolve_artifact(data_merged_sc_into_bl_file_path)] if data_merged_sc_into_bl_file_path is not None else [])
+
+    # Derived features to generate: those not dropped as predictors, added predictors, and the keys and target
+    requested_features = [feature for definition in feature_definitions.values() for feature in definition["outputs"]
+                          if feature not in drop_predictors] + add_predictors + [patient_key, time_key, base_target]
+
+    # Raw columns not to read: dropped predictors that are not added back
+    unused_columns = [column for column in drop_predictors if column not in add_predictors]
+
     # Filename suffixes
     filename_suffix = "{}_{}_{}_{}_{}_{}_{}{}{}".format(model_type, treated_untreated, on_off_dose, outcome_measure,
                                                         base_target,
@@ -1309,41 +2371,61 @@ def run(patient_key, time_key, model_type, is_regressor, base_target, outcome_me
             # If preprocessed data not provided
             if preprocessed_data is None:
                 # Data specific operations (cohorts=["PD", "GRPD", "GCPD"] )
-                preprocessed_data = preprocess_data(base_target, cohorts=cohorts, print_results=True,
-                                                    data_merged_sc_into_bl_file_path=data_merged_sc_into_bl_file_path,
-                                                    on_off_dose=on_off_dose, treated_untreated=treated_untreated,
-                                                    data_filename="data/output/preprocessed_data_{}_{}_{}.csv".format(
-                                                        treated_untreated, on_off_dose, '_'.join(cohorts)))
+                preprocessed_filename = "data/output/preprocessed_data_{}_{}_{}.csv".format(
+                    treated_untreated, on_off_dose, '_'.join(cohorts))
+                preprocessed_data = run_stage(preprocess_data, stage_cache_dir, raw_data_filenames,
+                                              [preprocessed_filename] + (["data/raw_data/data_merged_SC_into_BL.csv"]
+                                                                         if data_merged_sc_into_bl_file_path is None
+                                                                         else []),
+                                              base_target, cohorts=cohorts, print_results=True,
+                                              data_merged_sc_into_bl_file_path=data_merged_sc_into_bl_file_path,
+                                              on_off_dose=on_off_dose, treated_untreated=treated_untreated,
+                                              data_filename=preprocessed_filename, artifact_format=artifact_format,
+                                              export_csv=export_csv, requested_features=requested_features,
+                                              n_partitions=n_partitions, unused_columns=unused_columns,
+                                              cache_max_bytes=stage_cache_max_bytes)
+
+            # Read preprocessed partitions (processing needs all patients at once)
+            if isinstance(preprocessed_data, str):
+                preprocessed_data = read_artifact(preprocessed_data)
 
             # Print base target description
             print("\nBASE TARGET DESCRIPTION:\n{}\n".format(preprocessed_data[base_target].describe()))
 
             # Prepare data and generate outcome measure
-            processed_data = process_data(preprocessed_data, model_type, patient_key, time_key, base_target,
-                                          outcome_measure, drop_predictors, print_results=True, output_file=True,
-                                          data_filename="data/output/processed_data_{}.csv".format(filename_suffix),
-                                          cutoff=cutoff, post_lme_data=post_lme_data, time_from=time_from,
-                                          time_until=time_until)
+            processed_filename = "data/output/processed_data_{}.csv".format(filename_suffix)
+            processed_outputs = [processed_filename] + (
+                ["data/output/pre_LME_data.csv"] if model_type == "rate_of_progression" else [])
+            processed_data = run_stage(process_data, stage_cache_dir, [], processed_outputs, preprocessed_data,
+                                       model_type, patient_key, time_key, base_target, outcome_measure,
+                                       drop_predictors, print_results=True, output_file=True,
+                                       data_filename=processed_filename, cutoff=cutoff, post_lme_data=post_lme_data,
+                                       time_from=time_from, time_until=time_until, artifact_format=artifact_format,
+                                       export_csv=export_csv, n_jobs=n_jobs, lme_cache_dir=lme_cache_dir,
+                                       cache_max_bytes=stage_cache_max_bytes)
 
         # Print outcome measure description
         print("\nOUTCOME MEASURE DESCRIPTION BEFORE NA ELIMINATION:\n{}\n".format(
             processed_data[outcome_measure].describe()))
 
         # Maximize data dimensions w/o NAs
-        no_nulls_data = eliminate_nulls_maximally(processed_data, patient_key, time_key, outcome_measure,
-                                                  drop_predictors, add_predictors,
-                                                  na_elimination_n=na_elimination_n, print_results=True,
-                                                  balance_classes=balance_classes,
-                                                  data_filename="data/output/no_NAs_data_{}.csv".format(
-                                                      filename_suffix))
+        no_nulls_filename = "data/output/no_NAs_data_{}.csv".format(filename_suffix)
+        no_nulls_data = run_stage(eliminate_nulls_maximally, stage_cache_dir, [], [no_nulls_filename],
+                                  processed_data, patient_key, time_key, outcome_measure, drop_predictors,
+                                  add_predictors, na_elimination_n=na_elimination_n, print_results=True,
+                                  balance_classes=balance_classes, data_filename=no_nulls_filename,
+                                  artifact_format=artifact_format, export_csv=export_csv,
+                                  cache_max_bytes=stage_cache_max_bytes)
 
     # Print outcome measure description
     print("\nOUTCOME MEASURE DESCRIPTION AFTER NA ELIMINATION:\n{}\n".format(no_nulls_data[outcome_measure].describe()))
 
     # Primary run of model
-    primary_estimator = model(no_nulls_data, model_type, outcome_measure, is_regressor, drop_predictors,
-                              do_grid_search=do_grid_search, feature_importance_min=feature_importance_min,
-                              print_results=False, output_results=False, optimize_precision=optimize_precision)
+    primary_estimator = run_stage(model, stage_cache_dir, [], [], no_nulls_data, model_type, outcome_measure,
+                                  is_regressor, drop_predictors, do_grid_search=do_grid_search,
+                                  feature_importance_min=feature_importance_min, print_results=False,
+                                  output_results=False, optimize_precision=optimize_precision,
+                                  search_cache_dir=search_cache_dir, cache_max_bytes=stage_cache_max_bytes)
 
     # Final list of features: top predictors + keys + target
     # final_features = list(
@@ -1351,24 +2433,26 @@ def run(patient_key, time_key, model_type, is_regressor, base_target, outcome_me
     #                 [patient_key, time_key, outcome_measure]))
 
     # TODO: use above code to include added predictors (this was just for "not dropping")
-    final_features = list(
+    final_features = sorted(
         set(primary_estimator["Top Predictors"]).union([patient_key, time_key, outcome_measure]))
 
     # Print top ranking variables
     print("\n{} TOP RANKING VARIABLES: {}\n".format(len(final_features), final_features))
 
     # Eliminate nulls maximally from processed data without unused features
-    final_data = eliminate_nulls_maximally(processed_data, patient_key, time_key,
-                                           outcome_measure, drop_predictors, na_elimination_n=1,
-                                           print_results=True, dummy_features=primary_estimator["Dummy Features"],
-                                           final_features=final_features,
-                                           balance_classes=balance_classes,
-                                           data_filename="data/output/final_data_{}.csv".format(filename_suffix))
-
-    # Run model using top predictors
+    final_filename = "data/output/final_data_{}.csv".format(filename_suffix)
+    final_data = run_stage(eliminate_nulls_maximally, stage_cache_dir, [], [final_filename], processed_data,
+                           patient_key, time_key, outcome_measure, drop_predictors, na_elimination_n=1,
+                           print_results=True, dummy_features=primary_estimator["Dummy Features"],
+                           final_features=final_features,
+                           balance_classes=balance_classes, data_filename=final_filename,
+                           artifact_format=artifact_format, export_csv=export_csv,
+                           cache_max_bytes=stage_cache_max_bytes)
+
+    # Run model using top predictors (not cached, since it prints and appends its results)
     estimator = model(final_data, model_type, outcome_measure, is_regressor, drop_predictors,
                       do_grid_search=do_grid_search, print_results=True, output_results=True,
-                      optimize_precision=optimize_precision,
+                      optimize_precision=optimize_precision, search_cache_dir=search_cache_dir,
                       results_filename="data/output/results_{}.csv".format(filename_suffix))["Model"]
 
     # # Run model to predict on data
@@ -1,12 +1,21 @@
-from sklearn import preprocessing
 from sklearn.feature_selection import SelectKBest, f_classif
-from sklearn.model_selection import GridSearchCV, cross_val_score, train_test_split
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables halving search)
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, HalvingGridSearchCV, HalvingRandomSearchCV, \
+    check_cv, train_test_split
 from sklearn.metrics import confusion_matrix, classification_report, accuracy_score, mean_absolute_error, \
-    mean_squared_error, median_absolute_error, r2_score
+    mean_squared_error, median_absolute_error, r2_score, check_scoring
 from sklearn.ensemble import VotingClassifier
+from sklearn.base import clone, is_classifier
+from sklearn.exceptions import FitFailedWarning
+from joblib import Parallel, delayed
 from sklearn.preprocessing import MinMaxScaler
 import pandas as pd
 import numpy as np
+import argparse
+import hashlib
+import os
+import pickle
+import tempfile
 import warnings
 import matplotlib.pyplot as plt
 
@@ -56,48 +65,326 @@ def describe_data(data, info=False, describe=False, value_counts=None, unique=No
             print(feature, imp)
 
 
-def clean_data(data, encode_auto=None, encode_man=None, fillna=None, scale_features=None):
-    # Automatically encode features to numeric
-    if encode_auto is not None:
-        for feature in encode_auto:
-            data.loc[pd.isnull(data[feature]), feature] = "NaN"
-            data[feature] = preprocessing.LabelEncoder().fit_transform(data[feature])
-
-    # Manually encode features to numeric
-    if encode_man is not None:
-        for feature, encoding in encode_man.items():
-            for cur_value, new_value in encoding.items():
-                data.loc[data[feature] == cur_value, feature] = new_value
-
-    # Fill missing values either all at once or by feature depending on input type
-    if isinstance(fillna, str):
-        # Only fill on numeric features
-        numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-        for feature in data.select_dtypes(include=numerics).keys():
-            if fillna == "median":
-                data[feature] = data[feature].fillna(data[feature].median())
-            if fillna == "mean":
-                data[feature] = data[feature].fillna(data[feature].mean())
-            if fillna == "mode":
-                data[feature] = data[feature].fillna(data[feature].mode())
-    elif fillna is not None:
-        for feature, method in fillna:
-            if method == "median":
-                data[feature] = data[feature].fillna(data[feature].median())
-            if method == "mean":
-                data[feature] = data[feature].fillna(data[feature].mean())
-            if method == "mode":
-                data[feature] = data[feature].fillna(data[feature].mode())
+# Encodings of features to numeric, fitted once and reusable on new data
+class Encoder:
+    def __init__(self, encode_auto=None, encode_man=None):
+        # Features to encode automatically (as sorted category codes) and manual {feature: {value: code}} encodings
+        self.encode_auto = list(encode_auto) if encode_auto is not None else []
+        self.encode_man = dict(encode_man) if encode_man is not None else {}
+
+        # Fitted categories of automatically encoded features
+        self.categories = {}
+
+    def fit(self, data):
+        # Categories of each automatically encoded feature (missing values are their own "NaN" category)
+        for feature in self.encode_auto:
+            self.categories[feature] = pd.Categorical(data[feature].astype(object).fillna("NaN")).categories
+        return self
+
+    def transform(self, data):
+        # Replace automatically encoded features by their category codes (values unseen when fitting become -1)
+        for feature, categories in self.categories.items():
+            data[feature] = pd.Categorical(data[feature].astype(object).fillna("NaN"),
+                                           categories=categories).codes.astype("int64")
+
+        # Manually encode features with one map each (values without an encoding are kept, as are integer codes in the
+        # object column)
+        for feature, encoding in self.encode_man.items():
+            values = data[feature].astype(object)
+            encoded = values.isin(list(encoding))
+            values[encoded] = values[encoded].map(encoding).astype(object)
+            data[feature] = values
+        return data
+
+
+# Statistic of every column of a data frame (the first mode for "mode", null if a column has no values)
+def column_statistics(data, method):
+    if method == "mode":
+        return data.mode().reindex([0]).iloc[0]
+    return data.agg(method)
+
+
+# Fill of missing values, either all numeric features at once with one method (fillna="median", "mean", or "mode") or
+# by feature with [(feature, method)], optionally within groups (e.g. fill_by="PATNO"), falling back to the statistic
+# over all rows where a group has none. Statistics are fitted once and reusable on new data.
+class Filler:
+    def __init__(self, fillna, fill_by=None):
+        self.fillna = fillna
+        self.fill_by = fill_by
+
+        # Fitted features per method, and their statistics over all rows and per group
+        self.features = {}
+        self.statistics = {}
+        self.group_statistics = {}
+
+    def fit(self, data):
+        # Features per method (only numeric features when filling all at once)
+        if isinstance(self.fillna, str):
+            numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
+            self.features = {self.fillna: list(data.select_dtypes(include=numerics).columns)}
+        else:
+            self.features = {}
+            for feature, method in self.fillna:
+                self.features.setdefault(method, []).append(feature)
+
+        # Group keys are not filled
+        group_keys = [] if self.fill_by is None else [self.fill_by] if isinstance(self.fill_by, str) else \
+            list(self.fill_by)
+        self.features = dict((method, [feature for feature in features if feature not in group_keys])
+                             for method, features in self.features.items())
+
+        # Statistics of each method's features in one aggregation (per group in one grouped aggregation)
+        for method, features in self.features.items():
+            self.statistics[method] = column_statistics(data[features], method)
+            if self.fill_by is not None:
+                groups = data.groupby(self.fill_by)[features]
+                self.group_statistics[method] = groups.agg(
+                    lambda column: column_statistics(column, "mode")) if method == "mode" else groups.agg(method)
+        return self
+
+    def transform(self, data):
+        # Fill the whole block of each method's features at once
+        for method, features in self.features.items():
+            fill = self.statistics[method]
+            if self.fill_by is not None:
+                # Statistics of each row's group, or over all rows where its group has none
+                keys = data[self.fill_by] if isinstance(self.fill_by, str) else pd.MultiIndex.from_frame(
+                    data[self.fill_by])
+                group_fill = self.group_statistics[method].reindex(keys)
+                group_fill.index = data.index
+                fill = group_fill.fillna(fill)
+            data[features] = data[features].fillna(fill)
+        return data
+
+
+def clean_data(data, encode_auto=None, encode_man=None, fillna=None, scale_features=None, encoder=None, fill_by=None,
+               filler=None):
+    # Encode features to numeric (with the given fitted encoder, if any)
+    if encoder is None:
+        encoder = Encoder(encode_auto, encode_man).fit(data)
+    encoder.transform(data)
+
+    # Fill missing values (with the given fitted filler, if any)
+    if filler is None and fillna is not None:
+        filler = Filler(fillna, fill_by).fit(data)
+    if filler is not None:
+        filler.transform(data)
 
     # Scale values based on min and max
     if scale_features is not None:
         data[scale_features] = MinMaxScaler().fit_transform(data[scale_features])
 
+    # Return fitted encoder and filler
+    return {"Encoder": encoder, "Filler": filler}
+
+
+# Estimated relative cost of fitting an algorithm (so the most expensive fits are scheduled first)
+def estimate_fit_cost(alg, n_samples, n_features):
+    params = alg.get_params()
+    cost = float(n_samples) * n_features
+    if "n_estimators" in params:
+        cost *= params["n_estimators"]
+    if "kernel" in params:
+        cost *= n_samples / 100.0
+    return cost
+
+
+# Fit a copy of an algorithm on one fold and score it with every scoring at once (sklearn's multimetric scorer, which
+# computes each prediction method once for all of them). Failed fits raise, or with error_score=np.nan (like
+# cross_validate's) warn and score nan.
+def fit_and_score(index, fold, alg, X, y, train, test, scoring, error_score="raise"):
+    try:
+        fitted = clone(alg).fit(X.iloc[train], y.iloc[train])
+    except Exception as error:
+        if isinstance(error_score, str) and error_score == "raise":
+            raise
+        warnings.warn("Fitting failed on fold {}, scores set to {}: {!r}".format(fold, error_score, error),
+                      FitFailedWarning)
+        return index, fold, dict((key, error_score) for key in scoring)
+
+    # Score with every scoring
+    return index, fold, check_scoring(fitted, scoring=scoring)(fitted, X.iloc[test], y.iloc[test])
+
+
+# Cross validate several algorithms through one pool of n_jobs workers, one task per (algorithm, fold), each scored
+# with every scoring. Algorithms' own n_jobs are set to 1 so nested parallelism does not oversubscribe the pool.
+# on_result(index, results) is called for each algorithm as soon as all of its folds finish.
+def cross_validate_algs(algs, X, y, folds, scoring, n_jobs=-1, on_result=None, error_score="raise"):
+    # Tasks for every (algorithm, fold), with the same folds cross_validate would use
+    tasks = []
+    fold_counts = []
+    for index, alg in enumerate(algs):
+        # Single-threaded copy of algorithm
+        alg = clone(alg)
+        alg.set_params(**dict((key, 1) for key in alg.get_params() if key == "n_jobs" or key.endswith("__n_jobs")))
+
+        # Folds
+        splits = list(check_cv(folds, y, classifier=is_classifier(alg)).split(X, y))
+        fold_counts.append(len(splits))
+        for fold, (train, test) in enumerate(splits):
+            tasks.append((estimate_fit_cost(alg, len(train), X.shape[1]), index, fold, alg, train, test))
+
+    # Schedule most expensive tasks first
+    tasks.sort(key=lambda task: -task[0])
+
+    # Run tasks, collecting scores as they finish
+    fold_scores = [dict((key, [None] * fold_count) for key in scoring) for fold_count in fold_counts]
+    remaining = list(fold_counts)
+    all_results = [None] * len(algs)
+    parallel = Parallel(n_jobs=n_jobs, return_as="generator_unordered")
+    for index, fold, scores in parallel(delayed(fit_and_score)(index, fold, alg, X, y, train, test, scoring,
+                                                               error_score)
+                                        for cost, index, fold, alg, train, test in tasks):
+        # Store fold scores
+        for key, score in scores.items():
+            fold_scores[index][key][fold] = score
+        remaining[index] -= 1
+
+        # Output algorithm results once all of its folds finish
+        if remaining[index] == 0:
+            all_results[index] = dict(("test_{}".format(key), np.array(values))
+                                      for key, values in fold_scores[index].items())
+            if on_result is not None:
+                on_result(index, all_results[index])
+
+    # Return results of every algorithm
+    return all_results
+
+
+# Pickle an object to a file atomically (written to a temporary file in the same directory, then moved into place)
+def dump_atomic(obj, path):
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as temporary_file:
+            pickle.dump(obj, temporary_file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+# Content fingerprint of data frames, series, and any other objects (by repr)
+def fingerprint(*objects):
+    key = hashlib.sha1()
+    for obj in objects:
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            key.update(pd.util.hash_pandas_object(obj, index=False).values.tobytes())
+            key.update(repr(list(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name).encode("utf-8"))
+        else:
+            key.update(repr(obj).encode("utf-8"))
+    return key.hexdigest()
+
+
+# Load a cached search (marking it as recently used), or None if not cached
+def load_search(cache_dir, key):
+    path = os.path.join(cache_dir, "{}.pkl".format(key))
+    if not os.path.exists(path):
+        return None
+    os.utime(path, None)
+    with open(path, "rb") as cache_file:
+        return pickle.load(cache_file)
+
+
+# Cache a fitted search (params, mean and std scores, and best estimator), then evict least recently used searches
+# (a search larger than the whole cache is not kept)
+def store_search(cache_dir, key, search, max_bytes=2 ** 30):
+    path = os.path.join(cache_dir, "{}.pkl".format(key))
+    dump_atomic(search, path)
+    if os.path.getsize(path) > max_bytes:
+        os.remove(path)
+        return
+    evict_search_cache(cache_dir, max_bytes, keep=key)
+
+
+# Delete least recently used searches (except the one keyed keep) until the cache is at most max_bytes
+def evict_search_cache(cache_dir, max_bytes, keep=None):
+    entries = sorted((os.path.getmtime(path), os.path.getsize(path), path) for path in
+                     [os.path.join(cache_dir, filename) for filename in os.listdir(cache_dir)
+                      if filename.endswith(".pkl")])
+    total = sum(size for _, size, _ in entries)
+    entries = [entry for entry in entries if os.path.basename(entry[2]) != "{}.pkl".format(keep)]
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+# Delete one cached search by key, or every cached search
+def clear_search_cache(cache_dir, key=None):
+    if not os.path.isdir(cache_dir):
+        return
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".pkl") and (key is None or filename == "{}.pkl".format(key)):
+            os.remove(os.path.join(cache_dir, filename))
+
+
+# Train/test split shared by split reports, fitting each algorithm once and memoizing its predictions
+class SplitEvaluation:
+    # Initialize split
+    X_train = None
+    X_test = None
+    y_train = None
+    y_test = None
+    split_name = ""
+
+    def __init__(self, data, predictors, target, folds=5, random_state=None):
+        # Split the data into a training set and a test set
+        self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(data[predictors], data[target],
+                                                                                test_size=1.0 / folds,
+                                                                                random_state=random_state)
+
+        # Ratio of split
+        self.split_name = "{:g}/{:g} Split: ".format(100 - 100 / folds, 100 / folds)
+
+        # Memoized fits and predictions
+        self.fitted = {}
+        self.predictions = {}
+
+    def fit(self, alg, name):
+        # Fit a copy of the algorithm on the training set once
+        key = (name, id(alg))
+        if key not in self.fitted:
+            self.fitted[key] = clone(alg).fit(self.X_train, self.y_train)
+        return self.fitted[key]
+
+    def predict(self, alg, name):
+        # Predictions on the test set
+        key = (name, id(alg))
+        if key not in self.predictions:
+            self.predictions[key] = self.fit(alg, name).predict(self.X_test)
+        return self.predictions[key]
+
+
+# Largest number of successive halving candidates whose fits (every candidate of each iteration once per fold, plus
+# the refit) stay within a fit budget, and the smallest resources that give that many candidates enough iterations to
+# halve down to one (0 candidates if the budget is too small for even one)
+def halving_candidates(search_budget, folds, n_samples, smallest_resources, factor=3):
+    n_candidates, n_iterations = 0, 1
+    while True:
+        # Iterations required to halve candidates + 1 down to one
+        required_iterations = 1
+        while factor ** required_iterations <= n_candidates + 1:
+            required_iterations += 1
+
+        # Stop once their fits exceed the budget
+        fits = folds * sum(-(-(n_candidates + 1) // factor ** i) for i in range(required_iterations)) + 1
+        if fits > search_budget:
+            break
+        n_candidates, n_iterations = n_candidates + 1, required_iterations
+
+    # Resources of the first iteration (fewer iterations, and so fewer fits, if the data is too small)
+    return n_candidates, max(smallest_resources, n_samples // factor ** (n_iterations - 1))
+
 
 def metrics(data, predictors, target, algs, alg_names, feature_importances=None, base_score=None, oob_score=None,
             cross_val=None, folds=5, scoring="accuracy", split_accuracy=None, split_classification_report=None,
             split_confusion_matrix=None, plot=True, grid_search_params=None, n_jobs=-1, print_results=False,
-            feature_dictionary=None, description="METRICS:"):
+            feature_dictionary=None, description="METRICS:", split=None, split_random_state=None,
+            search_strategy="grid", search_budget=None, search_cache_dir=None, search_cache_max_bytes=2 ** 30):
     # Output dictionary
     output_dict = {}
 
@@ -137,58 +424,65 @@ def metrics(data, predictors, target, algs, alg_names, feature_importances=None,
         if print_results:
             print("OOB Score: {} [{}]".format(score, name))
 
-    # TODO: Update to newest model_selection sklearn module
-    # Cross validation
-    def print_cross_val(alg, name):
+    # Scorings as list
+    scorings = scoring if isinstance(scoring, list) else [scoring]
 
-        if scoring == "root_mean_squared_error":
-            scores = cross_val_score(alg, data[predictors], data[target], cv=folds, scoring="neg_mean_squared_error",
-                                     n_jobs=n_jobs)
-            output_dict["Cross Validation {} ".format(scoring) + name] = "{:0.2f} (+/- {:0.2f})".format(
+    # Cross validation output of each scoring (root mean squared error is derived from mean squared error)
+    def print_cross_val(name, results):
+        for index, score_type in enumerate(scorings):
+            scores = results["test_{}".format(index)]
+            if score_type == "root_mean_squared_error":
+                output_dict["Cross Validation {} ".format(score_type) + name] = "{:0.2f} (+/- {:0.2f})".format(
                     abs(scores.mean()) ** 0.5, scores.std() ** 0.5)
-            if print_results:
-                print("Cross Validation: {:0.2f} (+/- {:0.2f}) [{}] ({})".format(abs(scores.mean()) ** 0.5,
-                                                                                 scores.std() ** 0.5, name, scoring))
-        else:
-            scores = cross_val_score(alg, data[predictors], data[target], cv=folds, scoring=scoring, n_jobs=n_jobs)
-            output_dict["Cross Validation {} ".format(scoring) + name] = "{:0.2f} (+/- {:0.2f})".format(
+                if print_results:
+                    print("Cross Validation: {:0.2f} (+/- {:0.2f}) [{}] ({})".format(abs(scores.mean()) ** 0.5,
+                                                                                     scores.std() ** 0.5, name,
+                                                                                     score_type))
+            else:
+                output_dict["Cross Validation {} ".format(score_type) + name] = "{:0.2f} (+/- {:0.2f})".format(
                     abs(scores.mean()),
                     scores.std())
-            if print_results:
-                print("Cross Validation: {:0.2f} (+/- {:0.2f}) [{}] ({})".format(abs(scores.mean()), scores.std(), name,
-                                                                                 scoring))
+                if print_results:
+                    print("Cross Validation: {:0.2f} (+/- {:0.2f}) [{}] ({})".format(abs(scores.mean()), scores.std(),
+                                                                                     name, score_type))
 
     # Split accuracy
-    def print_split_accuracy(alg, name, split_name, X_train, X_test, y_train, y_test):
-        y_pred = alg.fit(X_train, y_train).predict(X_test)
-        if scoring == "accuracy":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, accuracy_score(y_test, y_pred), name, scoring))
-        elif scoring == "mean_absolute_error" or "neg_mean_absolute_error":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, mean_absolute_error(y_test, y_pred), name, scoring))
-        elif scoring == "root_mean_squared_error":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, mean_squared_error(y_test, y_pred) ** 0.5, name, scoring))
-        elif scoring == "mean_squared_error" or "neg_mean_squared_error":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, mean_squared_error(y_test, y_pred), name, scoring))
-        elif scoring == "median_absolute_error":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, median_absolute_error(y_test, y_pred), name, scoring))
-        elif scoring == "r2":
-            print("{}: {:0.2f} [{}] ({})".format(split_name, r2_score(y_test, y_pred), name, scoring))
+    def print_split_accuracy(alg, name):
+        y_test, y_pred = split.y_test, split.predict(alg, name)
+        for score_type in scoring if isinstance(scoring, list) else [scoring]:
+            if score_type == "accuracy":
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, accuracy_score(y_test, y_pred), name,
+                                                     score_type))
+            elif score_type in ("mean_absolute_error", "neg_mean_absolute_error"):
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, mean_absolute_error(y_test, y_pred), name,
+                                                     score_type))
+            elif score_type == "root_mean_squared_error":
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, mean_squared_error(y_test, y_pred) ** 0.5, name,
+                                                     score_type))
+            elif score_type in ("mean_squared_error", "neg_mean_squared_error"):
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, mean_squared_error(y_test, y_pred), name,
+                                                     score_type))
+            elif score_type == "median_absolute_error":
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, median_absolute_error(y_test, y_pred), name,
+                                                     score_type))
+            elif score_type == "r2":
+                print("{}: {:0.2f} [{}] ({})".format(split.split_name, r2_score(y_test, y_pred), name, score_type))
 
     # Split classification report
-    def print_split_classification_report(alg, name, X_train, X_test, y_train, y_test):
+    def print_split_classification_report(alg, name):
         print("Classification Report [" + name + "]")
-        y_pred = alg.fit(X_train, y_train).predict(X_test)
+        y_pred = split.predict(alg, name)
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            print(classification_report(y_test, y_pred))
+            print(classification_report(split.y_test, y_pred))
 
     # Split confusion matrix
-    def print_split_confusion_matrix(alg, name, X_train, X_test, y_train, y_test, display_plot=True):
+    def print_split_confusion_matrix(alg, name, display_plot=True):
         # Print algorithm name
         print("Confusion Matrix [" + name + "]")
 
         # Create predictions
-        y_pred = alg.fit(X_train, y_train).predict(X_test)
+        y_test, y_pred = split.y_test, split.predict(alg, name)
 
         # Compute confusion matrix
         cm = confusion_matrix(y_test, y_pred)
@@ -225,14 +519,70 @@ def metrics(data, predictors, target, algs, alg_names, feature_importances=None,
 
     # Grid search
     def print_grid_search(alg, name, params):
-        # Run grid search
-        if scoring == "root_mean_squared_error":
-            grid_search = GridSearchCV(estimator=alg, cv=folds, param_grid=params, scoring="neg_mean_squared_error",
-                                       verbose=1 if print_results else 0, n_jobs=n_jobs)
-        else:
-            grid_search = GridSearchCV(estimator=alg, cv=folds, param_grid=params, scoring=scoring,
-                                       verbose=1 if print_results else 0, n_jobs=n_jobs)
-        grid_search.fit(data[predictors], data[target])
+        # Search scoring
+        search_scoring = "neg_mean_squared_error" if scoring == "root_mean_squared_error" else scoring
+
+        # Grid search fits every candidate, so it cannot keep to a fit budget
+        if search_budget is not None and search_strategy == "grid":
+            raise ValueError("search_budget needs search_strategy 'random' or 'halving', not 'grid'")
+
+        # Number of candidates (and halving's smallest resources) that fit within the fit budget, counting the refit
+        n_candidates, min_resources = None, "smallest"
+        if search_budget is not None and search_strategy == "random":
+            n_candidates = (search_budget - 1) // folds
+        elif search_budget is not None and search_strategy == "halving":
+            n_candidates, min_resources = halving_candidates(
+                search_budget, folds, len(data.index),
+                2 * folds * (data[target].nunique() if is_classifier(alg) else 1))
+        if n_candidates is not None and n_candidates < 1:
+            raise ValueError("search_budget of {} fits is too small for {} folds".format(search_budget, folds))
+
+        # Cache key: fingerprint of training data, target, algorithm, parameters, and search settings
+        search_key = None if search_cache_dir is None else fingerprint(
+            data[predictors], data[target], type(alg).__name__, sorted(alg.get_params(deep=False).items()), params,
+            search_scoring, folds, search_strategy, search_budget)
+
+        # Load search from cache
+        grid_search = None if search_key is None else load_search(search_cache_dir, search_key)
+
+        # If search not cached
+        if grid_search is None:
+            # Run search (grid, random, or successive halving)
+            if search_strategy == "random":
+                grid_search = RandomizedSearchCV(estimator=alg, cv=folds, param_distributions=params,
+                                                 n_iter=10 if n_candidates is None else n_candidates,
+                                                 scoring=search_scoring, verbose=1 if print_results else 0,
+                                                 n_jobs=n_jobs)
+            elif search_strategy == "halving" and n_candidates is not None:
+                grid_search = HalvingRandomSearchCV(estimator=alg, cv=folds, param_distributions=params,
+                                                    n_candidates=n_candidates, min_resources=min_resources,
+                                                    scoring=search_scoring, verbose=1 if print_results else 0,
+                                                    n_jobs=n_jobs)
+            elif search_strategy == "halving":
+                grid_search = HalvingGridSearchCV(estimator=alg, cv=folds, param_grid=params, scoring=search_scoring,
+                                                  verbose=1 if print_results else 0, n_jobs=n_jobs)
+            else:
+                grid_search = GridSearchCV(estimator=alg, cv=folds, param_grid=params, scoring=search_scoring,
+                                           verbose=1 if print_results else 0, n_jobs=n_jobs)
+            grid_search.fit(data[predictors], data[target])
+
+            # Cache search
+            if search_key is not None:
+                store_search(search_cache_dir, search_key, grid_search, search_cache_max_bytes)
+
+        # Log candidates terminated early by successive halving (params, last iteration, score at last iteration)
+        if search_strategy == "halving":
+            candidates = {}
+            for candidate_params, iteration, score in zip(grid_search.cv_results_["params"],
+                                                          grid_search.cv_results_["iter"],
+                                                          grid_search.cv_results_["mean_test_score"]):
+                candidates[str(candidate_params)] = (candidate_params, iteration, score)
+            output_dict["Grid Search Eliminated " + name] = [candidate for candidate in candidates.values()
+                                                             if candidate[1] < grid_search.n_iterations_ - 1]
+            if print_results:
+                print("Eliminated Candidates [{}]".format(name))
+                for candidate_params, iteration, score in output_dict["Grid Search Eliminated " + name]:
+                    print("{} (iteration {}, score {})".format(candidate_params, iteration, score))
 
         if print_results:
             # Print algorithm being grid searched
@@ -307,18 +657,24 @@ def metrics(data, predictors, target, algs, alg_names, feature_importances=None,
     if cross_val is not None:
         if print_results:
             print("")
-        for i, val in enumerate(cross_val):
-            if val:
-                print_cross_val(algs[i], alg_names[i])
+        # Cross validate every selected algorithm (one fit per fold, scored with every scoring at once) through one
+        # shared pool, outputting each algorithm's scores as soon as all of its folds finish
+        cross_val_indices = [i for i, val in enumerate(cross_val) if val]
+        cross_validate_algs(algs=[algs[i] for i in cross_val_indices], X=data[predictors], y=data[target],
+                            folds=folds, n_jobs=n_jobs,
+                            scoring=dict((str(index), "neg_mean_squared_error"
+                                          if score_type == "root_mean_squared_error" else score_type)
+                                         for index, score_type in enumerate(scorings)),
+                            on_result=lambda j, results: print_cross_val(alg_names[cross_val_indices[j]], results))
 
     # If split is needed
     if split_accuracy is not None or split_classification_report is not None or split_confusion_matrix is not None:
-        # Split the data into a training set and a test set
-        X_train, X_test, y_train, y_test = train_test_split(data[predictors], data[target],
-                                                            test_size=1.0 / folds)
+        # Split the data into a training set and a test set (unless a split is provided)
+        if split is None:
+            split = SplitEvaluation(data, predictors, target, folds=folds, random_state=split_random_state)
 
-        # Print ratio of split
-        split_name = "{:g}/{:g} Split: ".format(100 - 100 / folds, 100 / folds)
+        # Output split for reuse across calls
+        output_dict["Split"] = split
 
         # Call respective methods
         if split_accuracy:
@@ -326,19 +682,19 @@ def metrics(data, predictors, target, algs, alg_names, feature_importances=None,
                 print("")
             for i, val in enumerate(split_accuracy):
                 if val:
-                    print_split_accuracy(algs[i], alg_names[i], split_name, X_train, X_test, y_train, y_test)
+                    print_split_accuracy(algs[i], alg_names[i])
         if split_classification_report:
             if print_results:
                 print("")
             for i, val in enumerate(split_classification_report):
                 if val:
-                    print_split_classification_report(algs[i], alg_names[i], X_train, X_test, y_train, y_test)
+                    print_split_classification_report(algs[i], alg_names[i])
         if split_confusion_matrix:
             if print_results:
                 print("")
             for i, val in enumerate(split_confusion_matrix):
                 if val:
-                    print_split_confusion_matrix(algs[i], alg_names[i], X_train, X_test, y_train, y_test, plot)
+                    print_split_confusion_matrix(algs[i], alg_names[i], plot)
 
     # Finish calling respective methods
     if grid_search_params is not None:
@@ -381,3 +737,18 @@ def ensemble(algs, alg_names, ensemble_name=None, in_ensemble=None, weights=None
 
     # Return ensemble and name
     return {"alg": alg, "name": name}
+
+
+# Search cache maintenance (example: python MachineLearning.py clear --cache-dir data/output/search_cache)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the hyperparameter search cache")
+    parser.add_argument("command", choices=["clear", "evict"], help="clear: invalidate searches, evict: shrink cache")
+    parser.add_argument("--cache-dir", default="data/output/search_cache")
+    parser.add_argument("--key", default=None, help="only invalidate this search (default: all)")
+    parser.add_argument("--max-bytes", type=int, default=2 ** 30, help="cache size to evict down to")
+    args = parser.parse_args()
+
+    if args.command == "clear":
+        clear_search_cache(args.cache_dir, args.key)
+    elif os.path.isdir(args.cache_dir):
+        evict_search_cache(args.cache_dir, args.max_bytes)
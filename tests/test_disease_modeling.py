@@ -0,0 +1,266 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DiseaseModeling as dM
+
+
+# The per-patient loop generate_treatment_status replaced
+def treatment_status_loop(data):
+    data = data.copy()
+    data.loc[:, "IS_TREATED"] = 0
+    for patient in data["PATNO"].unique():
+        if not data[(data["PATNO"] == patient) & (data["EVENT_ID"] == "ST")].empty:
+            st_date = pd.to_datetime(
+                data.loc[(data["PATNO"] == patient) & (data["EVENT_ID"] == "ST"), "INFODT"].values[0])
+            data.loc[(data["PATNO"] == patient) & (pd.to_datetime(data["INFODT"]) >= st_date), "IS_TREATED"] = 1
+    return data
+
+
+def synthetic_cohort(n_patients, st_probability, seed):
+    random = np.random.RandomState(seed)
+    rows = []
+    for patient in range(n_patients):
+        events = ["BL", "V01", "V02", "V03", "V04"]
+        if random.rand() < st_probability:
+            events.insert(random.randint(1, len(events)), "ST")
+        start = pd.Timestamp("2011-01-01") + pd.Timedelta(days=int(random.randint(0, 365)))
+        for visit, event in enumerate(events):
+            rows.append({"PATNO": 3000 + patient, "EVENT_ID": event,
+                         "INFODT": (start + pd.Timedelta(days=90 * visit)).strftime("%m/%Y")})
+    data = pd.DataFrame(rows)
+    return data.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def assert_matches_loop(data):
+    expected = treatment_status_loop(data)
+    actual = dM.generate_treatment_status(data=data, id_name="PATNO", event_name="EVENT_ID", datetime_name="INFODT")
+    assert list(actual["IS_TREATED"]) == list(expected["IS_TREATED"])
+
+
+def test_treatment_status_matches_loop_mixed_cohort():
+    data = synthetic_cohort(n_patients=50, st_probability=0.5, seed=0)
+    assert_matches_loop(data)
+    assert list(treatment_status_loop(data)["IS_TREATED"]) == list(treatment_status_loop_by_patient(data))
+
+
+def test_treatment_status_matches_loop_without_st_visits():
+    data = synthetic_cohort(n_patients=20, st_probability=0.0, seed=1)
+    assert_matches_loop(data)
+    assert (dM.generate_treatment_status(data=data, id_name="PATNO", event_name="EVENT_ID",
+                                         datetime_name="INFODT")["IS_TREATED"] == 0).all()
+
+
+def test_treatment_status_matches_loop_with_missing_dates():
+    data = synthetic_cohort(n_patients=30, st_probability=0.7, seed=2)
+    data.loc[data.index[::7], "INFODT"] = np.nan
+    assert_matches_loop(data)
+
+
+# The loop's conditions restricted to each patient's rows (the same result, without scanning every row per patient)
+def treatment_status_loop_by_patient(data):
+    dates = pd.to_datetime(data["INFODT"], format="%m/%Y").values
+    events = data["EVENT_ID"].values
+    is_treated = np.zeros(len(data.index), dtype=int)
+    for positions in data.groupby("PATNO").indices.values():
+        st_positions = positions[events[positions] == "ST"]
+        if len(st_positions):
+            is_treated[positions[dates[positions] >= dates[st_positions[0]]]] = 1
+    return is_treated
+
+
+def test_treatment_status_matches_loop_on_large_cohort():
+    data = synthetic_cohort(n_patients=10000, st_probability=0.5, seed=4)
+
+    # Vectorized on 10000 patients
+    start_time = time.time()
+    actual = dM.generate_treatment_status(data=data, id_name="PATNO", event_name="EVENT_ID", datetime_name="INFODT")
+    vectorized_time = time.time() - start_time
+    assert list(actual["IS_TREATED"]) == list(treatment_status_loop_by_patient(data))
+
+    # Old loop on 500 of them
+    sample = data[data["PATNO"].isin(data["PATNO"].unique()[:500])]
+    start_time = time.time()
+    treatment_status_loop(sample)
+    loop_time = time.time() - start_time
+    print("generate_treatment_status: {:.3f}s for 10000 patients, old loop {:.3f}s for 500".format(vectorized_time,
+                                                                                               loop_time))
+    assert vectorized_time < loop_time
+
+
+def future_cohort(n_patients, seed, grouped=True):
+    random = np.random.RandomState(seed)
+    rows = []
+    for patient in range(n_patients):
+        for visit in range(random.randint(2, 7)):
+            rows.append({"PATNO": 3000 + patient, "EVENT_ID": visit if visit < 4 else "V{:02d}".format(visit),
+                         "TIME_FROM_BL": round(0.25 * visit + random.rand() * 0.05 if visit else 0.0, 3),
+                         "UPDRS_III": float(random.randint(0, 60)) if random.rand() > 0.1 else np.nan,
+                         "GENDER": random.choice(["M", "F"])})
+    data = pd.DataFrame(rows)
+    return data if grouped else data.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def future_severity(data, n_jobs):
+    return dM.process_data(data.copy(), "future_severity", "PATNO", "TIME_FROM_BL", "UPDRS_III", "SCORE_FUTURE",
+                           drop_predictors=[], time_from=0.0, time_until=1.0, n_jobs=n_jobs)
+
+
+def test_future_severity_in_processes_matches_serial():
+    data = future_cohort(n_patients=40, seed=3)
+    serial = future_severity(data, n_jobs=None)
+    parallel = future_severity(data, n_jobs=2)
+    assert len(serial.index) > 0
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+def test_future_severity_in_processes_matches_serial_on_unsorted_input():
+    data = future_cohort(n_patients=40, seed=6, grouped=False)
+    pd.testing.assert_frame_equal(future_severity(data, n_jobs=2), future_severity(data, n_jobs=None))
+
+
+# The per-observation loop generate_future_score replaced (with pd.concat for the removed DataFrame.append)
+def future_score_loop(data, time_from, time_until):
+    data = data[data["UPDRS_III"].notnull()]
+    new_data = []
+    for index, observation in data.iterrows():
+        time_now = observation.at["TIME_FROM_BL"]
+        futures = data[(data["PATNO"] == observation.at["PATNO"]) & (data["TIME_FROM_BL"] > time_now + time_from) &
+                       (data["TIME_FROM_BL"] <= time_now + time_until)][["PATNO", "TIME_FROM_BL", "UPDRS_III"]]
+        futures = futures.rename(columns={"TIME_FROM_BL": "TIME_FUTURE", "UPDRS_III": "SCORE_FUTURE"})
+        if not futures.empty:
+            observation_futures = futures.merge(pd.DataFrame([observation]), on=["PATNO"], how="left")
+            observation_futures["TIME_PASSED"] = observation_futures["TIME_FUTURE"] - time_now
+            new_data.append(observation_futures)
+    return pd.concat(new_data, ignore_index=True)
+
+
+def test_future_score_matches_loop_grouped_by_patient():
+    data = future_cohort(n_patients=30, seed=7, grouped=False)
+    features = list(data.columns)
+    actual = dM.generate_future_score(data, features, "PATNO", "UPDRS_III", "TIME_FROM_BL", False, 0.0, 1.0,
+                                      chunk_size=7)
+
+    # The loop's pairs, patient by patient in order of first appearance
+    patients = pd.factorize(data["PATNO"])[0]
+    expected = future_score_loop(data.iloc[np.argsort(patients, kind="stable")], 0.0, 1.0)
+    columns = [column for column in features if column not in ["SCORE_NOW", "TIME_NOW"]]
+    pd.testing.assert_frame_equal(actual[columns], expected[columns], check_dtype=False)
+
+    # Now information is filled with the observation's score and time (the loop left it empty)
+    assert list(actual["SCORE_NOW"]) == list(actual["UPDRS_III"])
+    assert list(actual["TIME_NOW"]) == list(actual["TIME_FROM_BL"])
+
+
+def test_rewriting_an_artifact_in_another_format_replaces_it(tmp_path):
+    filename = str(tmp_path / "data.csv")
+    dM.write_artifact(pd.DataFrame({"SCORE": [1]}), filename, "parquet", export_csv=True)
+    dM.write_artifact(pd.DataFrame({"SCORE": [2]}), filename, "csv")
+    assert list(dM.read_artifact(filename)["SCORE"]) == [2]
+    dM.write_artifact(pd.DataFrame({"SCORE": [3]}), filename, "feather")
+    assert list(dM.read_artifact(filename)["SCORE"]) == [3]
+    assert sorted(os.listdir(str(tmp_path))) == ["data.feather"]
+
+
+def cohort_size(data, cohort):
+    return int((data["RECRUITMENT_CAT"] == cohort).sum())
+
+
+def test_stage_cache_replays_results_and_evicts_least_recently_used(tmp_path, capsys):
+    cache_dir = str(tmp_path)
+    data = pd.DataFrame({"RECRUITMENT_CAT": ["PD", "PD", "CONTROL"]})
+    assert dM.run_stage(cohort_size, cache_dir, [], [], data, "PD") == 2
+    assert dM.run_stage(cohort_size, cache_dir, [], [], data, "PD") == 2
+    assert "Loaded 'cohort_size' from stage cache" in capsys.readouterr().out
+    entry_size = os.path.getsize(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+    assert dM.run_stage(cohort_size, cache_dir, [], [], data, "CONTROL", cache_max_bytes=entry_size) == 1
+    assert len(os.listdir(cache_dir)) == 1
+    dM.run_stage(cohort_size, cache_dir, [], [], data, "CONTROL", cache_max_bytes=entry_size)
+    assert "Loaded 'cohort_size' from stage cache" in capsys.readouterr().out
+
+
+# The per-patient, per-column loop merge_screening_into_baseline replaced
+def screening_into_baseline_loop(data_merged):
+    data_merged = data_merged.copy()
+    for subject in data_merged["PATNO"].unique():
+        if not data_merged[(data_merged["PATNO"] == subject) & (data_merged["EVENT_ID"] == "SC")].empty:
+            for column in data_merged.keys():
+                if (data_merged.loc[(data_merged["PATNO"] == subject) & (
+                        data_merged["EVENT_ID"] == "BL"), column].isnull().values.all()) and (
+                        data_merged.loc[(data_merged["PATNO"] == subject) & (
+                            data_merged["EVENT_ID"] == "SC"), column].notnull().values.any()):
+                    data_merged.loc[(data_merged["PATNO"] == subject) & (data_merged["EVENT_ID"] == "BL"), column] = \
+                        data_merged.loc[(data_merged["PATNO"] == subject) & (data_merged["EVENT_ID"] == "SC"),
+                                        column].tolist()[-1]
+    return data_merged
+
+
+def screening_cohort(n_patients, seed):
+    random = np.random.RandomState(seed)
+    rows = []
+    for patient in range(n_patients):
+        events = ["SC"] * random.randint(0, 3) + (["BL"] if random.rand() < 0.9 else []) + ["V01", "V02"]
+        for event in events:
+            rows.append({"PATNO": 3000 + patient, "EVENT_ID": event,
+                         "SCORE": float(random.randint(0, 40)) if random.rand() < 0.5 else np.nan,
+                         "LAB": random.rand() if random.rand() < 0.3 else np.nan,
+                         "HANDED": random.choice(["Right", "Left"]) if random.rand() < 0.5 else np.nan})
+    return pd.DataFrame(rows).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def test_screening_into_baseline_matches_loop():
+    data = screening_cohort(n_patients=200, seed=5)
+    expected = screening_into_baseline_loop(data)
+    actual = dM.merge_screening_into_baseline(data.copy(), id_name="PATNO", event_name="EVENT_ID")
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+def test_raw_dates_parse_by_format_and_raise_on_malformed_dates():
+    values = pd.Series(["01/2011", "03/15/2012", "2013-06-01", "1950", np.nan], name="INFODT")
+    dates = dM.parse_raw_dates(values, "all_visits")
+    assert list(dates[:4]) == [pd.Timestamp("2011-01-01"), pd.Timestamp("2012-03-15"), pd.Timestamp("2013-06-01"),
+                               pd.Timestamp("1950-01-01")]
+    assert pd.isnull(dates[4])
+    with pytest.raises(ValueError, match="1 malformed dates in column 'INFODT' of 'all_visits'"):
+        dM.parse_raw_dates(pd.Series(["01/2011", "13/2011"], name="INFODT"), "all_visits")
+
+
+def test_raw_tables_skip_unused_columns_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/raw_data")
+    pd.DataFrame({"PATNO": [3001], "EVENT_ID": ["BL"], "INFODT": ["01/2011"], "NP1COG": [1], "COMMENTS": ["none"],
+                  "MOCA": [26]}).to_csv("data/raw_data/all_visits.csv", index=False)
+    data = dM.load_raw_table("all_visits", unused_columns=["EVENT_ID", "NP1COG", "COMMENTS"])
+    assert list(data.columns) == ["PATNO", "EVENT_ID", "INFODT", "NP1COG", "MOCA"]
+    assert data["INFODT"][0] == pd.Timestamp("2011-01-01")
+
+
+def test_linear_regressions_match_linregress():
+    random = np.random.RandomState(8)
+    rows = []
+    for patient in range(30):
+        n_visits = 2 + patient % 5
+        constant = patient % 6 == 0
+        for visit in range(n_visits):
+            rows.append({"PATNO": 3000 + patient, "TIME_FROM_BL": 0.5 * visit + random.rand() * 0.1,
+                         "UPDRS_III": 20.0 if constant else float(random.randint(0, 60))})
+    data = pd.DataFrame(rows)
+    regressions = dM.linear_regressions(data, "PATNO", "TIME_FROM_BL", "UPDRS_III")
+
+    # The same statistics as scipy.stats.linregress, including NaN r and p values for a constant target
+    for patient, patient_data in data.groupby("PATNO"):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = scipy.stats.linregress(patient_data["TIME_FROM_BL"], patient_data["UPDRS_III"])
+        actual = regressions.loc[patient]
+        for statistic, value in [("slope", expected.slope), ("intercept", expected.intercept),
+                                 ("r_value", expected.rvalue), ("p_value", expected.pvalue),
+                                 ("std_err", expected.stderr)]:
+            np.testing.assert_allclose(actual[statistic], value, rtol=1e-7, atol=1e-9, equal_nan=True,
+                                       err_msg="{} of patient {}".format(statistic, patient))
+    assert regressions.loc[3006, ["r_value", "p_value", "std_err"]].isnull().all()
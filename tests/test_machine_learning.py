@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import cross_validate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MachineLearning as mL
+
+
+def toy_classification():
+    X, y = make_classification(n_samples=120, n_features=6, random_state=0)
+    return pd.DataFrame(X, columns=["F{}".format(i) for i in range(6)]), pd.Series(y)
+
+
+def test_cross_validate_algs_scores_are_finite_and_match_cross_validate():
+    X, y = toy_classification()
+    algs = [LogisticRegression(), RandomForestClassifier(n_estimators=10, random_state=0)]
+    scoring = {"0": "accuracy", "1": "roc_auc", "2": "neg_log_loss"}
+    results = mL.cross_validate_algs(algs, X, y, folds=4, scoring=scoring, n_jobs=1)
+    for alg, result in zip(algs, results):
+        expected = cross_validate(alg, X, y, cv=4, scoring=scoring)
+        for key in scoring:
+            assert np.isfinite(result["test_{}".format(key)]).all()
+            np.testing.assert_allclose(result["test_{}".format(key)], expected["test_{}".format(key)])
+
+
+def test_cross_validate_algs_raises_on_failed_fits():
+    X, y = toy_classification()
+    X.iloc[0, 0] = np.nan
+    with pytest.raises(ValueError):
+        mL.cross_validate_algs([LogisticRegression()], X, y, folds=3, scoring={"0": "accuracy"}, n_jobs=1)
+
+
+def test_cross_validate_algs_scores_failed_fits_as_error_score():
+    X, y = toy_classification()
+    with pytest.warns(mL.FitFailedWarning):
+        results = mL.cross_validate_algs([LogisticRegression(C=-1.0)], X, y, folds=3, scoring={"0": "accuracy"},
+                                         n_jobs=1, error_score=np.nan)
+    assert np.isnan(results[0]["test_0"]).all()